@@ -0,0 +1,778 @@
+from support import read_files, read_solution, predict_languages, text_preprocess, normalize_lines
+from support import stream_lines, character_classes, CHARACTER_CLASSES
+from letterLangId import score_letters_model, score_letters_early_exit, early_exit_rate_letters
+from letterLangId import bigram_letter_dict, unigram_letter_dict, score_letters
+from letterLangId import train_letter_ngrams, score_letter_ngrams, MAX_ORDER
+from wordLangId import (bigram_word_dict, unigram_word_dict, score_words, score_words_model,
+                        score_words_early_exit, train_word_sketches, score_words_sketch_model, SKETCH_DEPTH)
+from wordLangId import count_word_store, early_exit_rate_words
+from wordLangId2 import (turing_smoothing_dict, turing_probability_table, score_words_gt_model,
+                         score_words_gt, score_words_gt_table, score_words_gt_sketch_model)
+from modelStore import TRAIN_PREFIX, discover_train_files, train_model, load_or_train, save_model
+from modelStore import update_model, smooth_updates, prune_model
+from modelStore import quantize_model, verify_quantization, QUANTIZED, SCORERS
+from scoreCache import ScoreCache, BigramMemo, score_cached
+from cascadeLangId import TIERS, classify_cascade, holdout_thresholds
+import numpy as np
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+#resource is not available on windows, where peak memory is not reported
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def time_scorer(scorer, test):
+    #runs a scorer on every sentence of the test set and returns the elapsed seconds
+    start = time.perf_counter()
+    for test_line in test:
+        scorer(test_line)
+    return time.perf_counter() - start
+
+
+def report(name, seconds, num_lines):
+    #write one benchmark result to the console
+    print('{:<40} {:>9.4f}s {:>12.0f} lines/sec'.format(name, seconds, num_lines/seconds))
+
+
+def read_labels(sol_file='LangId.sol'):
+    #returns the language of each test line, ie the solution without the line numbers
+    return [x.split(' ', 1)[1] for x in read_solution(sol_file)]
+
+
+def accuracy(scores, languages, labels):
+    #returns the fraction of lines whose best scoring language (scores has one row per
+    #line and one column per language) is their label
+    return np.mean([x == y for x, y in zip(predict_languages(scores, languages), labels)])
+
+
+def bench_word_scoring(train_file='LangId.train.English', test_file='LangId.test'):
+    #compares the scoring speed of the word bigram models on the test set
+    #the GT model is timed both with the original scorer, which sums all the counts
+    #for every bigram, and with the precomputed GT probability table
+    train = read_files(train_file)
+    test = read_files(test_file)
+    uniword = unigram_word_dict(train)
+    biword = bigram_word_dict(train)
+
+    start = time.perf_counter()
+    Nx_uni, uni_threshold, Nx_bi, bi_threshold = turing_smoothing_dict(uniword, biword)
+    report('GT smoothing dict (build)', time.perf_counter() - start, len(train))
+    start = time.perf_counter()
+    gt_table = turing_probability_table(uniword, biword)
+    report('GT probability table (build)', time.perf_counter() - start, len(train))
+
+    report('add-one score_words', time_scorer(
+        lambda line: score_words(line, uniword, biword), test), len(test))
+    report('GT score_words_gt_table', time_scorer(
+        lambda line: score_words_gt_table(line, gt_table), test), len(test))
+    #the original GT scorer is very slow, hence it is only timed on a few sentences
+    sample = test[:10]
+    report('GT score_words_gt (10 lines)', time_scorer(
+        lambda line: score_words_gt(line, uniword, biword,
+                                    Nx_uni, uni_threshold, Nx_bi, bi_threshold), sample), len(sample))
+
+
+def make_synthetic_corpora(directory, scale, train_files=None, seed=0):
+    #writes, for each language, a synthetic corpus scale times as large as its
+    #training corpus and returns the dict with the paths of the new files
+    #each synthetic line joins the beginning of a random training line with the end of
+    #another one: plain copies of the corpus would only have counts that are multiples
+    #of scale, so that no bigram would be seen once and GT smoothing would break down
+    if train_files is None:
+        train_files = discover_train_files()
+    rng = random.Random(seed)
+    paths = {}
+    for language, path in train_files.items():
+        paths[language] = os.path.join(directory, os.path.basename(path))
+        with open(path, 'rb') as source:
+            lines = [line.split(b' ') for line in source.read().splitlines() if line.strip()]
+        with open(paths[language], 'wb') as target:
+            for _ in range(scale * len(lines)):
+                first, second = rng.choice(lines), rng.choice(lines)
+                cut = rng.randrange(len(first) + 1)
+                target.write(b' '.join(first[:cut] + second[cut:]) + b'\n')
+    return paths
+
+
+def bench_parallel_training(scale=10, workers_list=(1, 2, 4), shard_size=None):
+    #times sharded training on a synthetic corpus for different numbers of workers
+    #and reports the speedup with respect to a single worker
+    directory = tempfile.mkdtemp()
+    try:
+        train_files = make_synthetic_corpora(directory, scale)
+        size = sum(os.path.getsize(path) for path in train_files.values())
+        #by default, every worker gets a few shards of each corpus
+        if shard_size is None:
+            shard_size = max(1 << 20, size // (len(train_files) * 4 * max(workers_list)))
+        print('Synthetic corpus: {:.1f} MB'.format(size / 1e6))
+        baseline = None
+        for workers in workers_list:
+            start = time.perf_counter()
+            train_model(train_files, workers=workers, shard_size=shard_size)
+            seconds = time.perf_counter() - start
+            baseline = baseline or seconds
+            print('{:<40} {:>9.4f}s {:>9.1f} MB/sec {:>6.2f}x'.format(
+                'training with {} worker(s)'.format(workers), seconds, size / 1e6 / seconds, baseline / seconds))
+    finally:
+        shutil.rmtree(directory)
+
+
+def make_synthetic_languages(directory, num_languages, train_files=None, seed=0):
+    #writes num_languages synthetic training corpora and returns the dict with their paths
+    #each synthetic language is one of the real training corpora with its letters
+    #shuffled by a random substitution cipher: it has the same statistics as a real
+    #language, but its own alphabet of letter bigrams and its own vocabulary of words
+    if train_files is None:
+        train_files = discover_train_files()
+    rng = random.Random(seed)
+    sources = list(train_files.values())
+    letters = bytes(range(ord('a'), ord('z') + 1))
+    paths = {}
+    for k in range(num_languages):
+        shuffled = bytearray(letters)
+        rng.shuffle(shuffled)
+        table = bytes.maketrans(letters + letters.upper(), bytes(shuffled) + bytes(shuffled).upper())
+        language = 'Synthetic{:02d}'.format(k)
+        paths[language] = os.path.join(directory, TRAIN_PREFIX + language)
+        with open(sources[k % len(sources)], 'rb') as source, open(paths[language], 'wb') as target:
+            target.write(source.read().translate(table))
+    return paths
+
+
+def bench_languages(num_languages_list=(3, 24), test_file='LangId.test'):
+    #times the scoring of the test set with models of an increasing number of languages
+    #and reports the cost with respect to the smallest model
+    test = read_files(test_file)
+    directory = tempfile.mkdtemp()
+    try:
+        baseline = {}
+        for num_languages in num_languages_list:
+            model = train_model(make_synthetic_languages(directory, num_languages))
+            for name, scorer in [('letter', score_letters_model),
+                                 ('add-one', score_words_model),
+                                 ('GT', score_words_gt_model)]:
+                start = time.perf_counter()
+                scorer(test, model)
+                seconds = time.perf_counter() - start
+                baseline.setdefault(name, (num_languages, seconds))
+                report('{} model, {} languages ({:.2f}x)'.format(
+                    name, num_languages, seconds / baseline[name][1]), seconds, len(test))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_early_exit(margins=(5, 10, 20, 40), rate_fractions=(1.0, 0.1, 0.0), test_file='LangId.test',
+                     sol_file='LangId.sol', doc_size=20):
+    #measures the speedup and the change of accuracy of early-exit scoring
+    #accuracy is measured on the lines of the test set; speed is also measured on long
+    #documents, made of doc_size consecutive test lines of the same language
+    #the bound grows with the bigrams left by rate per bigram (see early_exit_scores):
+    #the rates are fractions of the largest gap of each model between two languages for
+    #one bigram, with which early exit gives the predictions of full scoring
+    model = load_or_train()
+    test = read_files(test_file)
+    sol = read_labels(sol_file)
+    docs = []
+    doc_labels = []
+    for language in model['languages']:
+        lines = [line for line, label in zip(test, sol) if label == language]
+        for i in range(0, len(lines), doc_size):
+            docs.append(' '.join(lines[i:i + doc_size]))
+            doc_labels.append(language)
+    for name, full_scorer, early_scorer, max_rate in [
+            ('letter', score_letters_model, score_letters_early_exit, early_exit_rate_letters(model)),
+            ('add-one', score_words_model, score_words_early_exit, early_exit_rate_words(model)),
+            ('GT', score_words_gt_model,
+             lambda line, model, margin, rate: score_words_early_exit(line, model, margin, 'gt', rate),
+             early_exit_rate_words(model, 'gt'))]:
+        for data, labels, kind in [(test, sol, 'lines'), (docs, doc_labels, 'documents')]:
+            start = time.perf_counter()
+            full = full_scorer(data, model)
+            report('{} full scoring, {}'.format(name, kind), time.perf_counter() - start, len(data))
+            #number of bigrams scored by full scoring
+            if name == 'letter':
+                total = sum(len(line.replace(' ', '')) + len(line.split()) for line in data)
+            else:
+                total = sum(len(line.split()) + 1 for line in data)
+            for margin in margins:
+                for rate in [max_rate * fraction for fraction in rate_fractions]:
+                    start = time.perf_counter()
+                    results = [early_scorer(line, model, margin, rate=rate) for line in data]
+                    seconds = time.perf_counter() - start
+                    scores = np.array([line_scores for line_scores, consumed in results])
+                    consumed = sum(consumed for line_scores, consumed in results)
+                    report('{} early exit, {}, margin {}, rate {:.2f}'.format(name, kind, margin, rate), seconds,
+                           len(data))
+                    print('    bigrams scored {:.1%}, accuracy {:.1%} (full scoring {:.1%})'.format(
+                        consumed / total, accuracy(scores, model['languages'], labels),
+                        accuracy(full, model['languages'], labels)))
+
+
+def bench_cascade(test_file='LangId.test', sol_file='LangId.sol', repeat=10):
+    #compares the cascade (see cascadeLangId) with each of its tiers used alone:
+    #throughput on the test set repeated repeat times, and accuracy on the test set
+    model = load_or_train()
+    thresholds = holdout_thresholds()
+    test = read_files(test_file)
+    sol = read_labels(sol_file)
+    for name, scorer in TIERS:
+        start = time.perf_counter()
+        scorer(test * repeat, model)
+        seconds = time.perf_counter() - start
+        print('{:<40} {:>9.4f}s {:>12.0f} lines/sec {:>8.1%}'.format(
+            name + ' model alone', seconds, len(test) * repeat / seconds,
+            accuracy(scorer(test, model), model['languages'], sol)))
+    start = time.perf_counter()
+    classify_cascade(test * repeat, model, thresholds)
+    seconds = time.perf_counter() - start
+    scores, tiers = classify_cascade(test, model, thresholds)
+    print('{:<40} {:>9.4f}s {:>12.0f} lines/sec {:>8.1%}'.format(
+        'cascade', seconds, len(test) * repeat / seconds, accuracy(scores, model['languages'], sol)))
+    print('    lines decided by each tier: ' + ', '.join(
+        '{} {:.1%}'.format(name, np.mean(tiers == tier)) for tier, (name, scorer) in enumerate(TIERS)))
+
+
+def read_raw_lines(path):
+    #reads the lines of a file without cleaning them, decoded as in read_files
+    with open(path, 'rb') as file:
+        return file.read().decode('utf8', 'surrogateescape').splitlines()
+
+
+def bench_reader(scale=100):
+    #compares reading a synthetic corpus scale times as large as the English training
+    #corpus line by line from its memory map (stream_lines) with decoding the whole file
+    #at once: time to the first line, total time and peak of the memory allocated
+    #(the pages of the map are not allocations: they belong to the page cache)
+    #times are measured in a first run, memory in a second run, as tracing slows down
+    #the code; the first line includes building the table of character classes, as it
+    #does on the cold start of any script
+    directory = tempfile.mkdtemp()
+    try:
+        path = make_synthetic_corpora(directory, scale, {'English': discover_train_files()['English']})['English']
+        print('Synthetic corpus: {:.1f} MB'.format(os.path.getsize(path) / 1e6))
+        print('{:<40} {:>12} {:>10} {:>14}'.format('reader', 'first line', 'total', 'peak memory'))
+        for name, reader in [('stream_lines', lambda: stream_lines(path)),
+                             ('whole file', lambda: iter(filter(None, normalize_lines(read_raw_lines(path)))))]:
+            CHARACTER_CLASSES.clear()
+            start = time.perf_counter()
+            lines = reader()
+            next(lines)
+            first = time.perf_counter() - start
+            for line in lines:
+                pass
+            seconds = time.perf_counter() - start
+            tracemalloc.start()
+            for line in reader():
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print('{:<40} {:>11.4f}s {:>9.3f}s {:>11.1f} MB'.format(name, first, seconds, peak / 1e6))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_stream(scales=(300, 1000), workers_list=(1, 2), test_file='LangId.test'):
+    #runs streamLangId.py on the test file repeated scale times, in a new process per run
+    #so that the peak resident memory of each run is its own: throughput and memory
+    #should not depend on the size of the input
+    load_or_train()
+    with open(test_file, 'rb') as file:
+        test = file.read()
+    directory = tempfile.mkdtemp()
+    try:
+        print('{:<40} {:>10} {:>14}'.format('input, workers', 'lines/sec', 'peak memory'))
+        for scale in scales:
+            path = os.path.join(directory, 'test')
+            with open(path, 'wb') as file:
+                for _ in range(scale):
+                    file.write(test)
+            for workers in workers_list:
+                output = subprocess.run([sys.executable, 'streamLangId.py', path, os.path.join(directory, 'out'),
+                                         '--workers', str(workers)],
+                                        check=True, capture_output=True, text=True).stdout
+                print('{:<40} {}'.format('{:.1f} MB, {}'.format(os.path.getsize(path) / 1e6, workers),
+                                         output.strip()))
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_normalization(scales=(1, 100), workers_list=(1, 2, 4)):
+    #compares the line by line text_preprocess with the bulk normalize_lines on the
+    #training corpora (scale 1) and on synthetic corpora scale times as large
+    #the outputs of the two functions are checked to be identical
+    #every run of normalize_lines builds the table of character classes again, as on
+    #the cold start of a script; the time it takes is also reported alone
+    CHARACTER_CLASSES.clear()
+    start = time.perf_counter()
+    character_classes()
+    print('character_classes (table build): {:.2f} ms'.format((time.perf_counter() - start) * 1e3))
+    directory = tempfile.mkdtemp()
+    try:
+        for scale in scales:
+            train_files = discover_train_files()
+            if scale != 1:
+                train_files = make_synthetic_corpora(directory, scale, train_files)
+            lines = [line for path in train_files.values() for line in read_raw_lines(path)]
+            print('Corpus at scale {}: {} lines'.format(scale, len(lines)))
+            start = time.perf_counter()
+            expected = text_preprocess(lines)
+            baseline = time.perf_counter() - start
+            report('text_preprocess', baseline, len(lines))
+            for workers in workers_list:
+                CHARACTER_CLASSES.clear()
+                start = time.perf_counter()
+                output = normalize_lines(lines, workers)
+                seconds = time.perf_counter() - start
+                report('normalize_lines, {} worker(s) ({:.2f}x)'.format(workers, baseline / seconds),
+                       seconds, len(lines))
+                if output != expected:
+                    raise AssertionError('normalize_lines does not match text_preprocess')
+            del lines, expected, output
+            for path in train_files.values():
+                if path.startswith(directory):
+                    os.remove(path)
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_update(language='English', batch_sizes=(10, 100, 1000), test_file='LangId.test'):
+    #compares retraining the model from scratch with updating it in place, when new lines
+    #of a language arrive; the model is trained without the last lines of the corpus of
+    #language, which are then added in batches
+    #the updated model must give the same scores as the model trained on all the lines
+    train_files = discover_train_files()
+    test = read_files(test_file)
+    lines = read_raw_lines(train_files[language])
+    split = len(lines) - max(batch_sizes)
+    directory = tempfile.mkdtemp()
+    try:
+        partial_files = dict(train_files)
+        partial_files[language] = os.path.join(directory, os.path.basename(train_files[language]))
+        with open(partial_files[language], 'wb') as file:
+            file.write('\n'.join(lines[:split]).encode('utf8', 'surrogateescape') + b'\n')
+        start = time.perf_counter()
+        full = train_model(train_files)
+        report('retraining on all the corpora', time.perf_counter() - start, sum(
+            len(read_raw_lines(path)) for path in train_files.values()))
+        for batch_size in batch_sizes:
+            model = train_model(partial_files)
+            #the first update computes the statistics of the word counts
+            update_model(model, language, [])
+            start = time.perf_counter()
+            update_model(model, language, lines[split:split + batch_size])
+            report('update with {} lines'.format(batch_size), time.perf_counter() - start, batch_size)
+        model = train_model(partial_files)
+        #add all the remaining lines in small batches and check the result
+        for i in range(split, len(lines), min(batch_sizes)):
+            update_model(model, language, lines[i:i + min(batch_sizes)], smooth=False)
+        smooth_updates(model)
+        for scorer in [score_letters_model, score_words_model,
+                       score_words_gt_model]:
+            if not np.allclose(scorer(test, model), scorer(test, full)):
+                raise AssertionError('the updated model does not match the retrained model')
+        #a new language without any usable line is rejected, and the model is unchanged
+        try:
+            update_model(model, 'Unknown', ['', ' ... '])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('a new language without any line was added to the model')
+        if model['languages'] != full['languages']:
+            raise AssertionError('the model changed when a new language was rejected')
+    finally:
+        shutil.rmtree(directory)
+
+
+def make_traffic(test, num_lines, exponent=1.1, seed=0):
+    #samples num_lines lines of the test set with a zipf-like distribution, so that a
+    #few lines are repeated many times, like the boilerplate of real traffic
+    rng = np.random.default_rng(seed)
+    weights = 1 / np.arange(1, len(test) + 1) ** exponent
+    return [test[i] for i in rng.choice(len(test), num_lines, p=weights / weights.sum())]
+
+
+def bench_cache(num_lines=20000, batch_size=512, cache_sizes=(1 << 14, 1 << 16, 1 << 20),
+                test_file='LangId.test', train_file='LangId.train.English'):
+    #measures the speedup and the hit rate of the score cache on traffic with repeated
+    #lines, scored in batches like in the classifier, and of the bigram memo of the
+    #dict-based scorers
+    model = load_or_train()
+    test = read_files(test_file)
+    traffic = make_traffic(test, num_lines)
+    print('Traffic: {} lines, {} distinct'.format(len(traffic), len(set(traffic))))
+    start = time.perf_counter()
+    for i in range(0, len(traffic), batch_size):
+        score_words_model(traffic[i:i + batch_size], model)
+    baseline = time.perf_counter() - start
+    report('add-one model, no cache', baseline, len(traffic))
+    for policy in ['lru', 'lfu']:
+        for cache_size in cache_sizes:
+            cache = ScoreCache(cache_size, policy)
+            start = time.perf_counter()
+            for i in range(0, len(traffic), batch_size):
+                score_cached(traffic[i:i + batch_size], model, score_words_model, cache)
+            seconds = time.perf_counter() - start
+            report('add-one model, {} cache {} KB ({:.2f}x)'.format(policy, cache_size >> 10, baseline / seconds),
+                   seconds, len(traffic))
+            print('    hit rate {:.1%}, {} entries'.format(cache.stats()['hit_rate'], cache.stats()['entries']))
+    #the dict-based scorers are slow, hence they are timed on a part of the traffic
+    train = read_files(train_file)
+    uniword = unigram_word_dict(train)
+    biword = bigram_word_dict(train)
+    sample = traffic[:2000]
+    report('score_words, no memo', time_scorer(lambda line: score_words(line, uniword, biword), sample),
+           len(sample))
+    memo = BigramMemo()
+    report('score_words, bigram memo', time_scorer(lambda line: score_words(line, uniword, biword, memo), sample),
+           len(sample))
+    print('    hit rate {:.1%}, {} entries'.format(memo.stats()['hit_rate'], memo.stats()['entries']))
+
+
+def dict_memory(counts):
+    #approximate memory used by a python dict of counts, including its keys and values
+    return sys.getsizeof(counts) + sum(sys.getsizeof(key) + sys.getsizeof(value)
+                                       for key, value in counts.items())
+
+
+def store_memory(store):
+    #approximate memory used by a word store (see wordLangId.count_word_store),
+    #including its list of words
+    return (sum(store[name].nbytes for name in ['unigram_counts', 'offsets', 'successors', 'counts'])
+            + sys.getsizeof(store['words']) + sum(sys.getsizeof(word) for word in store['words']))
+
+
+def bench_word_store(test_file='LangId.test'):
+    #compares the word counts kept in dicts keyed by strings (unigram_word_dict and
+    #bigram_word_dict) with the two-level store of the vectorized model: memory of
+    #the counts of each language and time to count them, and memory of the index of
+    #the bigrams of the trained model against one int64 key per bigram
+    print('{:<12} {:>14} {:>14} {:>10} {:>10} {:>10}'.format(
+        'language', 'dicts (KB)', 'store (KB)', 'reduction', 'dicts (s)', 'store (s)'))
+    for language, path in discover_train_files().items():
+        train = read_files(path)
+        start = time.perf_counter()
+        dicts = dict_memory(unigram_word_dict(train)) + dict_memory(bigram_word_dict(train))
+        dict_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        store = store_memory(count_word_store(train))
+        store_seconds = time.perf_counter() - start
+        print('{:<12} {:>14.0f} {:>14.0f} {:>9.1f}x {:>10.3f} {:>10.3f}'.format(
+            language, dicts / 1024, store / 1024, dicts / store, dict_seconds, store_seconds))
+    model = load_or_train()
+    index = model['bigram_offsets'].nbytes + model['bigram_successors'].nbytes
+    keys = len(model['bigram_successors']) * np.dtype(np.int64).itemsize
+    print('bigram index of the model: {:.0f} KB (int64 keys: {:.0f} KB)'.format(index / 1024, keys / 1024))
+    test = read_files(test_file)
+    start = time.perf_counter()
+    score_words_model(test, model)
+    report('score_words_model', time.perf_counter() - start, len(test))
+
+
+def bench_letter_ngrams(max_order=MAX_ORDER, test_file='LangId.test', sol_file='LangId.sol', repeat=10):
+    #compares the letter n-gram models of orders 1 to max_order with the letter bigram
+    #model of the trained model: accuracy and scoring throughput (on the test set
+    #repeated repeat times), and the time to count all orders against the time to train
+    #the whole model
+    train_files = discover_train_files()
+    train = {language: read_files(path) for language, path in train_files.items()}
+    test = read_files(test_file)
+    sol = read_labels(sol_file)
+    start = time.perf_counter()
+    model = train_model(train_files)
+    report('train_model (all three models)', time.perf_counter() - start, sum(map(len, train.values())))
+    start = time.perf_counter()
+    ngram_counts = train_letter_ngrams(train, max_order)
+    report('train_letter_ngrams (orders 1-{})'.format(max_order), time.perf_counter() - start,
+           sum(map(len, train.values())))
+
+    start = time.perf_counter()
+    score_letters_model(test * repeat, model)
+    seconds = time.perf_counter() - start
+    print('{:<40} {:>9.4f}s {:>12.0f} lines/sec {:>8.1%}'.format(
+        'score_letters_model', seconds, len(test) * repeat / seconds, accuracy(score_letters_model(test, model), model['languages'], sol)))
+    for order in range(1, max_order + 1):
+        start = time.perf_counter()
+        score_letter_ngrams(test * repeat, ngram_counts, order)
+        seconds = time.perf_counter() - start
+        print('{:<40} {:>9.4f}s {:>12.0f} lines/sec {:>8.1%}'.format(
+            'score_letter_ngrams order {}'.format(order), seconds, len(test) * repeat / seconds,
+            accuracy(score_letter_ngrams(test, ngram_counts, order), model['languages'], sol)))
+
+
+def bench_pruning(min_counts=(1, 2, 3, 5, 10), drop_fractions=(0.5, 0.75, 0.9, 0.95),
+                  test_file='LangId.test', sol_file='LangId.sol', repeat=10):
+    #compares the model pruned at each level (see modelStore.prune_model) with the full
+    #model (min_count 1): size of the model file, number of words and of word bigrams,
+    #and the throughput (on the test set repeated repeat times) and accuracy of each of
+    #the three language models
+    model = load_or_train()
+    test = read_files(test_file)
+    sol = read_labels(sol_file)
+    levels = ([('min_count {}'.format(x), x, 0.0) for x in min_counts] +
+              [('drop {:.0%} by entropy'.format(x), 1, x) for x in drop_fractions])
+    print('{:<22} {:>10} {:>7} {:>8}'.format('pruning', 'size (KB)', 'words', 'bigrams') +
+          ''.join(' {:>21}'.format(name + ' lines/s, acc') for name in SCORERS))
+    directory = tempfile.mkdtemp()
+    try:
+        for name, min_count, drop_fraction in levels:
+            pruned = prune_model(model, min_count, drop_fraction)
+            path = os.path.join(directory, 'model')
+            save_model(pruned, path)
+            row = '{:<22} {:>10.0f} {:>7} {:>8}'.format(name, os.path.getsize(path) / 1024, len(pruned['words']),
+                                                      len(pruned['bigram_successors']))
+            for scorer in SCORERS.values():
+                start = time.perf_counter()
+                scorer(test * repeat, pruned)
+                seconds = time.perf_counter() - start
+                row += ' {:>13.0f} {:>7.1%}'.format(len(test) * repeat / seconds,
+                                                    accuracy(scorer(test, pruned), pruned['languages'], sol))
+            print(row)
+    finally:
+        shutil.rmtree(directory)
+
+
+def bench_quantization(dtypes=('float64', 'float32', 'int16'), test_file='LangId.test', repeat=10):
+    #compares the smoothed log-probability tables stored as float64, float32 and int16
+    #(see modelStore.quantize_model): size of the tables, throughput of the three
+    #language models on the test set repeated repeat times, predictions changed and
+    #largest drift of the scores against float64
+    model = load_or_train()
+    test = read_files(test_file)
+    print('{:<10} {:>12}'.format('type', 'tables (KB)') +
+          ''.join(' {:>30}'.format(name + ' lines/s, changed, drift') for name in SCORERS))
+    for dtype in dtypes:
+        quantized = model if dtype == 'float64' else quantize_model(model, dtype)
+        size = sum(quantized[name].nbytes for names in QUANTIZED.values() for name in names)
+        results = verify_quantization(model, quantized, test)
+        row = '{:<10} {:>12.0f}'.format(dtype, size / 1024)
+        for name, scorer in SCORERS.items():
+            start = time.perf_counter()
+            scorer(test * repeat, quantized)
+            seconds = time.perf_counter() - start
+            row += ' {:>13.0f} {:>7} {:>8.1e}'.format(len(test) * repeat / seconds, results[name]['changed'],
+                                                     results[name]['max_drift'])
+        print(row)
+
+
+def bench_sketch(widths=(1 << 10, 1 << 12, 1 << 14, 1 << 16, 1 << 18), depth=SKETCH_DEPTH,
+                 test_file='LangId.test', sol_file='LangId.sol'):
+    #compares the memory usage and the accuracy of the word models when bigrams are
+    #counted in exact dicts or in count-min sketches of different widths
+    train_files = discover_train_files()
+    languages = list(train_files)
+    test = read_files(test_file)
+    sol = read_labels(sol_file)
+    train = {language: read_files(path) for language, path in train_files.items()}
+    uniword = {language: unigram_word_dict(train[language]) for language in languages}
+    biword = {language: bigram_word_dict(train[language]) for language in languages}
+
+    memory = sum(dict_memory(biword[language]) for language in languages)
+    gt_tables = {language: turing_probability_table(uniword[language], biword[language]) for language in languages}
+    print('{:<24} {:>12} {:>10} {:>10}'.format('bigram counts', 'memory (KB)', 'add-one', 'GT'))
+    print('{:<24} {:>12.0f} {:>10.1%} {:>10.1%}'.format(
+        'exact dict', memory / 1024,
+        accuracy(np.array([[score_words(line, uniword[language], biword[language]) for language in languages]
+                           for line in test]), languages, sol),
+        accuracy(np.array([[score_words_gt_table(line, gt_tables[language]) for language in languages]
+                           for line in test]), languages, sol)))
+    for width in widths:
+        sketch_model = train_word_sketches(train_files, width, depth)
+        memory = sum(sketch['table'].nbytes for sketch in sketch_model['sketches'])
+        print('{:<24} {:>12.0f} {:>10.1%} {:>10.1%}'.format(
+            'sketch {}x{}'.format(depth, width), memory / 1024,
+            accuracy(score_words_sketch_model(test, sketch_model), languages, sol),
+            accuracy(score_words_gt_sketch_model(test, sketch_model), languages, sol)))
+
+
+#the suite below times each stage of the three language models separately and
+#records the results in a machine-readable (json) format
+#a run can be compared with a stored baseline: it fails if a stage got slower, or
+#needs more memory, than the baseline by more than a given tolerance
+#memory is the peak of the memory allocated by a stage (measured by tracemalloc in a
+#second run of the stage, as tracing slows down the code)
+DEFAULT_TOLERANCE = 0.25
+#a single run of a stage of a few milliseconds is too noisy to compare with a baseline:
+#a stage is run again until its runs add up to STAGE_MIN_SECONDS, at most STAGE_RUNS
+#times, and its time is the best of its runs
+STAGE_MIN_SECONDS = 1.0
+STAGE_RUNS = 10
+
+
+def run_stage(results, name, num_lines, function, *args, memory=True):
+    #runs one stage of the suite, records its results and returns its output
+    times = []
+    while not times or (sum(times) < STAGE_MIN_SECONDS and len(times) < STAGE_RUNS):
+        #the output of the previous run is freed before the next one
+        output = None
+        start = time.perf_counter()
+        output = function(*args)
+        times.append(time.perf_counter() - start)
+    seconds = min(times)
+    stage = {'seconds': seconds, 'runs': len(times), 'lines': num_lines, 'lines_per_sec': num_lines / seconds}
+    if memory:
+        del output
+        tracemalloc.start()
+        output = function(*args)
+        stage['peak_mb'] = tracemalloc.get_traced_memory()[1] / 1e6
+        tracemalloc.stop()
+    results['stages'][name] = stage
+    report(name, seconds, num_lines)
+    return output
+
+
+def run_suite(scale=10, memory=True, test_file='LangId.test'):
+    #times every stage of the three language models on a synthetic corpus scale times
+    #as large as the training corpora; the test set is repeated scale times as well
+    results = {'scale': scale, 'stages': {}}
+    directory = tempfile.mkdtemp()
+    try:
+        train_files = make_synthetic_corpora(directory, scale)
+        languages = list(train_files)
+        train_size = sum(os.path.getsize(path) for path in train_files.values())
+        test = read_files(test_file) * scale
+        #reading and cleaning the corpora
+        train = {}
+        for language, path in train_files.items():
+            train[language] = run_stage(results, 'read_files.' + language,
+                                        sum(1 for line in open(path, 'rb')), read_files, path, memory=memory)
+        num_lines = sum(len(lines) for lines in train.values())
+        #cleaning of the raw lines, line by line and in bulk
+        raw = [line for path in train_files.values() for line in read_raw_lines(path)]
+        run_stage(results, 'text_preprocess', len(raw), text_preprocess, raw, memory=memory)
+        run_stage(results, 'normalize_lines', len(raw), normalize_lines, raw, memory=memory)
+        del raw
+        #counting, one stage per function and per model
+        counts = {}
+        for name, count in [('unigram_letter_dict', unigram_letter_dict),
+                            ('bigram_letter_dict', bigram_letter_dict),
+                            ('unigram_word_dict', unigram_word_dict),
+                            ('bigram_word_dict', bigram_word_dict)]:
+            counts[name] = run_stage(results, name, num_lines,
+                                     lambda: [count(train[language]) for language in languages], memory=memory)
+        run_stage(results, 'count_word_store', num_lines,
+                  lambda: [count_word_store(train[language]) for language in languages], memory=memory)
+        uniletter, biletter, uniword, biword = [counts[name] for name in
+                                                ['unigram_letter_dict', 'bigram_letter_dict',
+                                                 'unigram_word_dict', 'bigram_word_dict']]
+        #GT smoothing
+        run_stage(results, 'turing_smoothing_dict', num_lines,
+                  lambda: [turing_smoothing_dict(uni, bi) for uni, bi in zip(uniword, biword)], memory=memory)
+        gt_tables = run_stage(results, 'turing_probability_table', num_lines,
+                              lambda: [turing_probability_table(uni, bi) for uni, bi in zip(uniword, biword)],
+                              memory=memory)
+        #training of the vectorized model, streaming the corpora
+        model = run_stage(results, 'train_model', num_lines, train_model, train_files, memory=memory)
+        #scoring with the original scorers, which score one sentence with one language at a time
+        run_stage(results, 'score_letters', len(test),
+                  lambda: [[score_letters(line, uni, bi) for uni, bi in zip(uniletter, biletter)]
+                           for line in test], memory=memory)
+        run_stage(results, 'score_words', len(test),
+                  lambda: [[score_words(line, uni, bi) for uni, bi in zip(uniword, biword)]
+                           for line in test], memory=memory)
+        run_stage(results, 'score_words_gt_table', len(test),
+                  lambda: [[score_words_gt_table(line, gt_table) for gt_table in gt_tables]
+                           for line in test], memory=memory)
+        #scoring with the vectorized scorers, which score all sentences with all languages
+        run_stage(results, 'score_letters_model', len(test), score_letters_model, test, model, memory=memory)
+        run_stage(results, 'score_words_model', len(test), score_words_model, test, model, memory=memory)
+        run_stage(results, 'score_words_model.gt', len(test), score_words_model, test, model, 'gt',
+                  memory=memory)
+        #size of the model
+        save_model(model, os.path.join(directory, 'model'))
+        results['train_mb'] = train_size / 1e6
+        results['model_file_mb'] = os.path.getsize(os.path.join(directory, 'model')) / 1e6
+        results['count_dicts_mb'] = sum(dict_memory(table) for tables in counts.values()
+                                        for table in tables) / 1e6
+    finally:
+        shutil.rmtree(directory)
+    #peak resident memory of the whole run (ru_maxrss is in KB on linux)
+    if resource is not None:
+        results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+    return results
+
+
+def compare_results(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    #compares the results of the suite with a baseline and returns the list of regressions
+    #throughput must not drop, and memory must not grow, by more than tolerance
+    if results['scale'] != baseline['scale']:
+        return ['scale {} does not match the scale {} of the baseline'.format(
+            results['scale'], baseline['scale'])]
+    regressions = []
+    for name, expected in baseline['stages'].items():
+        stage = results['stages'].get(name)
+        if stage is None:
+            regressions.append('{}: stage is missing'.format(name))
+            continue
+        if stage['lines_per_sec'] < expected['lines_per_sec'] * (1 - tolerance):
+            regressions.append('{}: {:.0f} lines/sec, baseline {:.0f} lines/sec'.format(
+                name, stage['lines_per_sec'], expected['lines_per_sec']))
+        if 'peak_mb' in stage and 'peak_mb' in expected and stage['peak_mb'] > expected['peak_mb'] * (1 + tolerance):
+            regressions.append('{}: peak memory {:.1f} MB, baseline {:.1f} MB'.format(
+                name, stage['peak_mb'], expected['peak_mb']))
+    for name in ['model_file_mb', 'count_dicts_mb', 'peak_rss_mb']:
+        if name in results and name in baseline and results[name] > baseline[name] * (1 + tolerance):
+            regressions.append('{}: {:.1f}, baseline {:.1f}'.format(name, results[name], baseline[name]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the language models')
+    parser.add_argument('--scale', type=int, default=10,
+                        help='size of the synthetic corpus, as a multiple of the training corpora')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4],
+                        help='numbers of worker processes for parallel training')
+    parser.add_argument('--languages', type=int, nargs='+', default=[3, 24],
+                        help='numbers of synthetic languages for the multi-language benchmark')
+    parser.add_argument('--normalize-scales', type=int, nargs='+', default=[1, 100],
+                        help='sizes of the corpora for the normalization benchmark')
+    parser.add_argument('--suite', action='store_true',
+                        help='run the stage by stage suite instead of the benchmarks above')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='do not measure the peak memory of each stage of the suite')
+    parser.add_argument('--output', help='json file where the results of the suite are written')
+    parser.add_argument('--baseline', help='json file with the results of a previous run of the suite')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='relative regression allowed with respect to the baseline')
+    args = parser.parse_args()
+    if args.suite:
+        results = run_suite(args.scale, not args.no_memory)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(results, file, indent=2)
+        if args.baseline:
+            with open(args.baseline) as file:
+                regressions = compare_results(results, json.load(file), args.tolerance)
+            for regression in regressions:
+                print('REGRESSION ' + regression)
+            if regressions:
+                sys.exit(1)
+        return
+    bench_word_scoring()
+    bench_parallel_training(args.scale, args.workers)
+    bench_languages(args.languages)
+    bench_early_exit()
+    bench_cascade()
+    bench_sketch()
+    bench_normalization(args.normalize_scales, args.workers)
+    bench_reader()
+    bench_stream()
+    bench_update()
+    bench_cache()
+    bench_word_store()
+    bench_letter_ngrams()
+    bench_pruning()
+    bench_quantization()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+from support import read_files, read_solution, write_out, compute_performance, make_output
+from modelStore import load_or_train, discover_train_files, count_corpus, compile_model, save_model, MODEL_FILE
+from modelStore import SCORERS
+from profiler import profiled, profiling_enabled, count, dump_profile
+import numpy as np
+import time
+
+#this script chains the three language models in a cascade, from the fastest to the
+#most accurate: every line is scored by the letter bigram model, and only the lines on
+#which a model is unsure are scored again by the next model
+#a model is unsure of a line when the margin between its two highest scores is not
+#above the threshold of the model; the last model decides all the lines left
+#thresholds are calibrated on lines held out of the training corpora (see
+#holdout_thresholds): the threshold of a model is the margin of its most confident
+#mistake on those lines
+
+#the tiers of the cascade, with the function that scores a batch of lines
+TIERS = [(name, SCORERS[name]) for name in ['letter', 'word', 'word_gt']]
+#fraction of each training corpus held out to calibrate the thresholds
+HOLDOUT = 0.1
+
+
+def score_margins(scores):
+    #returns the gap between the two highest scores of each line
+    if scores.shape[1] < 2:
+        return np.full(len(scores), np.inf)
+    top_two = np.partition(scores, -2, axis=1)[:, -2:]
+    return top_two[:, 1] - top_two[:, 0]
+
+
+@profiled('classify_cascade')
+def classify_cascade(sentence_list, model, thresholds):
+    #this function scores a list of sentences with the cascade of TIERS
+    #thresholds has the margin threshold of every tier but the last
+    #returns a matrix with the scores of the tier that decided each sentence (one row
+    #per sentence and one column per language) and the index of that tier
+    scores = np.zeros((len(sentence_list), len(model['languages'])))
+    tiers = np.zeros(len(sentence_list), dtype=np.int64)
+    pending = np.arange(len(sentence_list))
+    for tier, (name, scorer) in enumerate(TIERS):
+        tier_scores = scorer([sentence_list[i] for i in pending], model)
+        if tier < len(thresholds):
+            accepted = score_margins(tier_scores) > thresholds[tier]
+        else:
+            accepted = np.ones(len(pending), dtype=bool)
+        scores[pending[accepted]] = tier_scores[accepted]
+        tiers[pending[accepted]] = tier
+        count('classify_cascade.' + name, np.count_nonzero(accepted))
+        pending = pending[~accepted]
+        if not len(pending):
+            break
+    return scores, tiers
+
+
+def calibrate_thresholds(sentence_list, labels, model):
+    #returns the threshold of every tier but the last, ie the margin of the most
+    #confident mistake of the tier on the labelled sentences (0 if it made none)
+    languages = np.array(model['languages'])
+    thresholds = []
+    for name, scorer in TIERS[:-1]:
+        scores = scorer(sentence_list, model)
+        wrong = languages[np.argmax(scores, axis=1)] != np.array(labels)
+        thresholds.append(float(score_margins(scores)[wrong].max(initial=0)))
+    return thresholds
+
+
+@profiled('holdout_thresholds')
+def holdout_thresholds(train_files=None, holdout=HOLDOUT):
+    #calibrates the thresholds on the last lines (a fraction holdout) of each training
+    #corpus, with a model trained on the other lines: lines seen in training would make
+    #every model look more confident than it is on new lines
+    if train_files is None:
+        train_files = discover_train_files()
+    counts = {}
+    held_out = []
+    labels = []
+    for language, path in train_files.items():
+        lines = read_files(path)
+        size = int(len(lines) * holdout)
+        counts[language] = count_corpus(lines[:len(lines) - size])
+        held_out += lines[len(lines) - size:]
+        labels += [language] * size
+    return calibrate_thresholds(held_out, labels, compile_model(counts))
+
+
+def load_thresholds(model, path=MODEL_FILE, train_files=None):
+    #returns the thresholds of the cascade saved with the model (see modelStore.METADATA)
+    #the first time, they are calibrated with holdout_thresholds, which trains a model
+    #again, and saved in the model file, so that the following runs start right away
+    #a model trained again (eg after the corpora changed) is calibrated again
+    if 'cascade_thresholds' not in model:
+        if train_files is None:
+            train_files = discover_train_files()
+        model['cascade_thresholds'] = holdout_thresholds(train_files)
+        save_model(model, path, train_files)
+    return model['cascade_thresholds']
+
+
+def make_output_cascade(test, model, thresholds):
+    #this function takes the test sentences, a trained model and the thresholds of the
+    #cascade and returns a list with the predicted language for each sentence and the
+    #index of the tier that decided each sentence
+    scores, tiers = classify_cascade(test, model, thresholds)
+    return make_output(scores, model['languages']), tiers
+
+
+def main():
+    #load the trained model of all languages (see modelStore)
+    model = load_or_train()
+    #thresholds of the cascade, calibrated on the first run
+    thresholds = load_thresholds(model)
+    #read test data
+    test = read_files('LangId.test')
+    #read ground truth, ie the solution
+    sol = read_solution('LangId.sol')
+
+    #create list with predicted languages of all sentences in test data
+    start = time.perf_counter()
+    output_cascade, tiers = make_output_cascade(test, model, thresholds)
+    seconds = time.perf_counter() - start
+
+    #write output to file
+    write_out('cascadeLangId.out', output_cascade)
+
+    #write performance to the console
+    perf = compute_performance(output_cascade, sol)
+    print('Accuracy of the cascade of letter, word and Good-Turing word bigram models: {}%'.format(perf))
+    for tier, (name, scorer) in enumerate(TIERS):
+        threshold = 'margin > {:.2f}'.format(thresholds[tier]) if tier < len(thresholds) else 'all the rest'
+        print('Lines decided by the {} model ({}): {:.1%}'.format(name, threshold, np.mean(tiers == tier)))
+    print('Throughput: {:.0f} lines/sec'.format(len(test) / seconds))
+
+    #write the profile to the standard error if profiling is on (see profiler)
+    if profiling_enabled():
+        dump_profile()
+
+
+if __name__ == "__main__":
+    main()
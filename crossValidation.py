@@ -0,0 +1,147 @@
+from support import read_files, predict_languages
+from modelStore import discover_train_files, count_corpus, merge_counts, compile_model
+from modelStore import copy_model, subtract_counts, smooth_updates, SCORERS
+from profiler import profiled, profiling_enabled, dump_profile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import argparse
+import time
+
+#k-fold cross-validation of the three language models on the training corpora
+#the lines of each corpus are split in k folds of consecutive lines, and the model of a
+#fold is trained on the other k - 1 folds and tested on the fold
+#every fold is counted once: the counts of the whole corpora are the sum of the counts
+#of the folds, and the model of a fold is the model of the whole corpora minus the
+#counts of the fold (see modelStore.subtract_counts), which updates the Nx's of GT
+#smoothing with the changed counts only; nothing is counted or sorted again per fold
+#folds can be evaluated in parallel by a pool of processes
+
+#default number of folds
+FOLDS = 5
+#model of the whole corpora and counts of the folds, in the worker processes
+STATE = {}
+
+
+def split_folds(lines, folds):
+    #splits a list of lines in folds of consecutive lines, of sizes that differ by 1 at most
+    bounds = np.linspace(0, len(lines), folds + 1).astype(np.int64)
+    return [lines[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+@profiled('count_folds')
+def count_folds(train_files, folds):
+    #reads and splits the training corpora and counts every fold of every language
+    #returns the counts of each fold (a dict that maps each language to its counts), the
+    #lines of each fold and their languages
+    fold_counts = [{} for _ in range(folds)]
+    fold_lines = [[] for _ in range(folds)]
+    fold_labels = [[] for _ in range(folds)]
+    for language, path in train_files.items():
+        for fold, lines in enumerate(split_folds(read_files(path), folds)):
+            fold_counts[fold][language] = count_corpus(lines)
+            fold_lines[fold] += lines
+            fold_labels[fold] += [language] * len(lines)
+    return fold_counts, fold_lines, fold_labels
+
+
+def confusion_matrix(predicted, labels, languages):
+    #returns the matrix with the number of lines of each language (rows) predicted as
+    #each language (columns)
+    index = {language: i for i, language in enumerate(languages)}
+    matrix = np.zeros((len(languages), len(languages)), dtype=np.int64)
+    np.add.at(matrix, ([index[x] for x in labels], [index[x] for x in predicted]), 1)
+    return matrix
+
+
+def init_worker(model, fold_counts):
+    STATE['model'] = model
+    STATE['fold_counts'] = fold_counts
+
+
+def evaluate_fold(fold, lines, labels):
+    #builds the model of a fold by subtraction and scores the lines of the fold with
+    #the three language models
+    #returns, for each model, the confusion matrix and the scoring time, and the time
+    #it took to build the model of the fold
+    start = time.perf_counter()
+    model = copy_model(STATE['model'])
+    for language, counts in STATE['fold_counts'][fold].items():
+        subtract_counts(model, language, counts)
+    smooth_updates(model)
+    results = {'build_seconds': time.perf_counter() - start, 'models': {}}
+    for name, scorer in SCORERS.items():
+        start = time.perf_counter()
+        predicted = predict_languages(scorer(lines, model), model['languages'])
+        results['models'][name] = {'confusion': confusion_matrix(predicted, labels, model['languages']),
+                                   'score_seconds': time.perf_counter() - start}
+    return results
+
+
+@profiled('cross_validate')
+def cross_validate(train_files=None, folds=FOLDS, workers=1):
+    #runs k-fold cross-validation of the three language models
+    #by default, on all the corpora found by discover_train_files
+    #returns a dict with the languages, the time it took to count the folds and to train
+    #the model of the whole corpora and, for each fold, the results of evaluate_fold
+    if train_files is None:
+        train_files = discover_train_files()
+    start = time.perf_counter()
+    fold_counts, fold_lines, fold_labels = count_folds(train_files, folds)
+    count_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    model = compile_model({language: merge_counts(counts[language] for counts in fold_counts)
+                           for language in train_files})
+    train_seconds = time.perf_counter() - start
+    if workers == 1:
+        init_worker(model, fold_counts)
+        results = [evaluate_fold(fold, fold_lines[fold], fold_labels[fold]) for fold in range(folds)]
+    else:
+        with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(model, fold_counts)) as pool:
+            results = list(pool.map(evaluate_fold, range(folds), fold_lines, fold_labels))
+    return {'languages': model['languages'],
+            'count_seconds': count_seconds,
+            'train_seconds': train_seconds,
+            'folds': results}
+
+
+def report_cross_validation(results):
+    #writes the accuracy of each model (overall and per fold), its confusion matrix and
+    #the timings of a cross-validation to the console
+    languages = results['languages']
+    folds = results['folds']
+    print('Counted {} folds in {:.2f}s, trained the model of all folds in {:.2f}s'.format(
+        len(folds), results['count_seconds'], results['train_seconds']))
+    #retraining would count the other folds again and compile their counts
+    print('Built the model of each fold by subtraction in {:.2f}s on average '
+          '(retraining: about {:.2f}s per fold)'.format(
+              np.mean([fold['build_seconds'] for fold in folds]),
+              results['count_seconds'] * (len(folds) - 1) / len(folds) + results['train_seconds']))
+    for name in SCORERS:
+        matrices = [fold['models'][name]['confusion'] for fold in folds]
+        confusion = sum(matrices)
+        accuracies = [np.trace(matrix) / matrix.sum() for matrix in matrices]
+        lines = int(confusion.sum())
+        seconds = sum(fold['models'][name]['score_seconds'] for fold in folds)
+        print('\n{} model: accuracy {:.2%} (folds: {}), {:.0f} lines/sec'.format(
+            name, np.trace(confusion) / lines, ', '.join('{:.2%}'.format(x) for x in accuracies),
+            lines / seconds))
+        width = max(len(language) for language in languages) + 2
+        print(' ' * width + ''.join(language.rjust(width) for language in languages))
+        for language, row in zip(languages, confusion):
+            print(language.ljust(width) + ''.join(str(x).rjust(width) for x in row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='k-fold cross-validation of the language models')
+    parser.add_argument('--folds', type=int, default=FOLDS, help='number of folds')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes that evaluate the folds')
+    args = parser.parse_args()
+    report_cross_validation(cross_validate(folds=args.folds, workers=args.workers))
+    #write the profile to the standard error if profiling is on (see profiler)
+    if profiling_enabled():
+        dump_profile()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+from support import normalize_lines
+from modelStore import SCORERS, load_model, load_or_train
+from profiler import profiled, enable_profiling, profiling_enabled, profile_report
+from scoreCache import ScoreCache, score_cached
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import argparse
+import collections
+import io
+import json
+import queue
+import sys
+import threading
+import time
+
+#this script runs a resident classifier: the trained model is loaded once and lines
+#are classified as they arrive, over http or on the standard input
+#concurrent requests are grouped in micro-batches, so that the vectorized scorers
+#run once per batch and not once per request
+
+#maximum number of lines in a micro-batch and maximum time (in seconds) that the
+#first request of a batch waits for other requests to join it
+MAX_BATCH = 512
+MAX_WAIT = 0.002
+#number of recent requests used to compute latency percentiles
+LATENCY_WINDOW = 10000
+
+
+@profiled('classify_lines')
+def classify_lines(lines, model, decision='word', caches=None):
+    #this function classifies a list of raw lines with the three language models
+    #lines are cleaned exactly as the test corpus (see normalize_lines)
+    #for each line, it returns a dict with the language predicted by the model chosen
+    #by decision and, for each model, the predicted language and the score of all languages
+    #caches optionally maps each model to a scoreCache.ScoreCache, keyed on clean lines
+    clean = normalize_lines(lines)
+    languages = model['languages']
+    if caches:
+        scores = {name: score_cached(clean, model, scorer, caches[name])
+                  for name, scorer in SCORERS.items()}
+    else:
+        scores = {name: scorer(clean, model) for name, scorer in SCORERS.items()}
+    results = []
+    for i in range(len(lines)):
+        result = {}
+        for name in SCORERS:
+            line_scores = scores[name][i]
+            result[name] = {'language': languages[int(np.argmax(line_scores))],
+                            'scores': dict(zip(languages, line_scores.tolist()))}
+        result['language'] = result[decision]['language']
+        results.append(result)
+    return results
+
+
+class Metrics:
+    #collects the latency of recent requests and the throughput of the classifier
+    def __init__(self, window=LATENCY_WINDOW):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.start = time.perf_counter()
+        self.requests = 0
+        self.lines = 0
+        self.batches = 0
+        self.busy = 0
+
+    def record_batch(self, num_lines, latencies, seconds):
+        #seconds is the time spent classifying the batch
+        with self.lock:
+            self.busy += seconds
+            self.batches += 1
+            self.lines += num_lines
+            self.requests += len(latencies)
+            self.latencies.extend(latencies)
+
+    def report(self):
+        #returns the metrics as a dict; latencies are in milliseconds
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            uptime = time.perf_counter() - self.start
+            return {'requests': self.requests,
+                    'lines': self.lines,
+                    'batches': self.batches,
+                    'lines_per_batch': self.lines / self.batches if self.batches else 0,
+                    'lines_per_sec': self.lines / uptime,
+                    'busy_lines_per_sec': self.lines / self.busy if self.busy else 0,
+                    'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                    'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                    'uptime_sec': uptime}
+
+
+class MicroBatcher:
+    #groups the lines of concurrent requests in micro-batches that are classified
+    #together by a single background thread
+    #with cache_bytes > 0, the scores of the lines already seen are cached: each of the
+    #three models gets a third of cache_bytes
+    def __init__(self, model, decision='word', max_batch=MAX_BATCH, max_wait=MAX_WAIT,
+                 cache_bytes=0, cache_policy='lru'):
+        self.model = model
+        self.decision = decision
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.metrics = Metrics()
+        self.caches = None
+        if cache_bytes > 0:
+            self.caches = {name: ScoreCache(cache_bytes // len(SCORERS), cache_policy) for name in SCORERS}
+        self.requests = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def report(self):
+        #returns the metrics and, if any, the statistics of the caches
+        report = self.metrics.report()
+        if self.caches:
+            report['caches'] = {name: cache.stats() for name, cache in self.caches.items()}
+        return report
+
+    def submit(self, lines):
+        #queues a list of lines for classification and returns a future with the results
+        #anything but a list of strings is refused here: it would fail the whole batch
+        if not isinstance(lines, list) or not all(isinstance(line, str) for line in lines):
+            raise TypeError('expected a list of lines')
+        future = Future()
+        self.requests.put((lines, future, time.perf_counter()))
+        return future
+
+    def next_batch(self):
+        #waits for a request, then collects the requests that arrive within max_wait
+        #until the batch holds max_batch lines
+        batch = [self.requests.get()]
+        num_lines = len(batch[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while num_lines < self.max_batch:
+            try:
+                request = self.requests.get(timeout=max(0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            batch.append(request)
+            num_lines += len(request[0])
+        return batch
+
+    def run(self):
+        #an error fails the requests of its batch but never stops this thread, otherwise
+        #every later request would wait forever
+        while True:
+            try:
+                batch = self.next_batch()
+            except Exception:
+                continue
+            try:
+                self.classify_batch(batch)
+            except Exception as error:
+                for request_lines, future, start in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def classify_batch(self, batch):
+        lines = [line for request_lines, future, start in batch for line in request_lines]
+        begin = time.perf_counter()
+        results = classify_lines(lines, self.model, self.decision, self.caches)
+        #split the results of the batch among its requests
+        end = time.perf_counter()
+        position = 0
+        for request_lines, future, start in batch:
+            future.set_result(results[position:position + len(request_lines)])
+            position += len(request_lines)
+        self.metrics.record_batch(len(lines), [end - start for request_lines, future, start in batch],
+                                  end - begin)
+
+
+def make_handler(batcher):
+    #returns the http request handler of a classifier
+    #POST /classify takes either a json object {"lines": [...]} or plain text with one
+    #line per row and returns {"results": [...]}; GET /metrics returns the metrics and the
+    #statistics of the caches, and GET /profile returns the profile of the models when profiling is on (see profiler)
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/metrics':
+                self.send_json(batcher.report())
+            elif self.path == '/profile' and profiling_enabled():
+                self.send_json(profile_report())
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            if self.path != '/classify':
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            body = body.decode('utf8', 'surrogateescape')
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                try:
+                    lines = json.loads(body)['lines']
+                except (ValueError, KeyError, TypeError):
+                    lines = None
+                if not isinstance(lines, list) or not all(isinstance(line, str) for line in lines):
+                    self.send_error(400, 'expected a json object with a list of lines')
+                    return
+            else:
+                lines = body.splitlines()
+            try:
+                results = batcher.submit(lines).result()
+            except Exception as error:
+                self.send_error(500, 'classification failed: {}'.format(error))
+                return
+            self.send_json({'results': results})
+
+        def send_json(self, data):
+            payload = json.dumps(data).encode('utf8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            #requests are not logged, to keep the console readable
+            pass
+
+    return Handler
+
+
+def serve_http(batcher, host='127.0.0.1', port=8000):
+    #serves the classifier over http until interrupted
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    print('Classifier listening on http://{}:{}'.format(host, port), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def serve_stdin(batcher, input_stream=None, output_stream=sys.stdout):
+    #classifies newline-delimited text from the standard input and writes one json
+    #result per line to the standard output, in the same order as the input
+    #every line is submitted as soon as it is read, while a writer thread prints the
+    #results in order: lines that arrive close to each other share a micro-batch
+    #the input is decoded like the corpora, see read_files
+    if input_stream is None:
+        input_stream = io.TextIOWrapper(sys.stdin.buffer, encoding='utf8', errors='surrogateescape')
+    futures = queue.Queue()
+
+    def write_results():
+        while True:
+            future = futures.get()
+            if future is None:
+                break
+            output_stream.write(json.dumps(future.result()[0]) + '\n')
+            output_stream.flush()
+
+    writer = threading.Thread(target=write_results)
+    writer.start()
+    for line in input_stream:
+        futures.put(batcher.submit([line.rstrip('\n')]))
+    futures.put(None)
+    writer.join()
+    print(json.dumps(batcher.report()), file=sys.stderr)
+    if profiling_enabled():
+        print(json.dumps(profile_report()), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resident language identification service')
+    parser.add_argument('--model', help='path of a trained model (default: train or load the model of the '
+                                        'corpora of the working directory, see load_or_train)')
+    parser.add_argument('--decision', default='word', choices=list(SCORERS),
+                        help='language model that gives the predicted language')
+    parser.add_argument('--stdin', action='store_true',
+                        help='classify the standard input instead of serving http')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH)
+    parser.add_argument('--max-wait', type=float, default=MAX_WAIT)
+    parser.add_argument('--cache-mb', type=float, default=0,
+                        help='memory bound (in MB) of the cache of the scores of the lines already seen')
+    parser.add_argument('--cache-policy', default='lru', choices=['lru', 'lfu'])
+    parser.add_argument('--profile', action='store_true',
+                        help='time the stages of the models and count their lookups (see profiler)')
+    args = parser.parse_args()
+    if args.profile:
+        enable_profiling()
+    #an explicit model is loaded as it is: it need not match the corpora of the working directory
+    model = load_model(args.model) if args.model else load_or_train()
+    batcher = MicroBatcher(model, args.decision, args.max_batch, args.max_wait,
+                           int(args.cache_mb * (1 << 20)), args.cache_policy)
+    if args.stdin:
+        serve_stdin(batcher)
+    else:
+        serve_http(batcher, args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
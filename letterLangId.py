@@ -1,6 +1,10 @@
-from support import read_files, text_preprocess, write_out, compute_performance
+from support import read_files, read_solution, text_preprocess, write_out, compute_performance
+from support import BEGIN_ID, END_ID, UNKNOWN_ID, FIRST_ID, sum_by_sentence, sentence_starts, make_output
+from support import merge_key_counts
+from support import EARLY_EXIT_BLOCK, early_exit_scores, max_log_ratio
+from profiler import profiled, profiling_enabled, count_dict_lookups, count_model_lookups, dump_profile
+from scoreCache import score_cached
 import numpy as np
-import operator
 
 def make_letter_key(one_word, i):
     #this function should be called while iterating through the letters of a word
@@ -20,6 +24,7 @@ def make_letter_key(one_word, i):
     return key
 
 
+@profiled('bigram_letter_dict')
 def bigram_letter_dict(sentence_list):
     #function to obtain count of each letter bigram in the train corpus
     #input is a list of strings
@@ -41,6 +46,7 @@ def bigram_letter_dict(sentence_list):
     return letter_bigrams_dict
 
 
+@profiled('unigram_letter_dict')
 def unigram_letter_dict(sentence_list):
     #function to obtain count of each letter unigram in the train corpus
     #input is a list of strings
@@ -63,13 +69,16 @@ def unigram_letter_dict(sentence_list):
     return letter_unigrams_dict
 
 
-def score_letters(sentence, uniletter, biletter):
+@profiled('score_letters')
+def score_letters(sentence, uniletter, biletter, memo=None):
     #this is the function that performs the language model scoring for letter bigrams
     #it takes a sentence, a python dict with count of unigrams in train
     #and a python dict with count of bigrams in train and returns the add-one smoothed
     #probability that the provided sentence is in the language of the two dictionaries
     #note that smoothing is done on the fly for counts and smoothed counts are
     #then turned into probabilities on the fly using MLE
+    #memo is an optional scoreCache.BigramMemo of the language of the two dictionaries:
+    #bigrams found in the memo are not smoothed again
 
     #V is the size of the vocabulary, ie the count of distinct unigrams
     V = len(uniletter)
@@ -81,6 +90,10 @@ def score_letters(sentence, uniletter, biletter):
     for one_word in sentence.split():
         for i in range(0, len(one_word)+1):
             bigram_key = make_letter_key(one_word, i)
+            if memo is not None and bigram_key in memo:
+                memo.hits += 1
+                score += memo[bigram_key]
+                continue
             unigram_key = bigram_key.split(',')[0]
             
             #here we perform the add-one smoothing of the counts
@@ -102,57 +115,339 @@ def score_letters(sentence, uniletter, biletter):
             
             #turn counts into conditional probability using MLE    
             proba = np.log(numerator/denominator)
+            if memo is not None:
+                memo.add(bigram_key, proba)
             score += proba
+    if profiling_enabled():
+        keys = [make_letter_key(one_word, i) for one_word in sentence.split()
+                for i in range(0, len(one_word)+1)]
+        count_dict_lookups('score_letters', keys, [key.split(',')[0] for key in keys],
+                           biletter, uniletter)
     return score
 
 
-def make_output_letter(test,
-                       uniletter_dict_eng, biletter_dict_eng,
-                       uniletter_dict_ita, biletter_dict_ita,
-                       uniletter_dict_fra, biletter_dict_fra):
-    #this function takes the test sentences and a series of unigram/bigram counts
-    #and returns a list with the predicted language for each sentence in the test set
-    #for each sentence, model is scored using the ENG, ITA and FRA dictionaries
-    #then, the predicted language is simply the one associated to the highest probability
+#the functions below implement a vectorized version of the letter bigram model
+#letters are interned to integer ids once at training time (see support.py for the
+#reserved ids), so that the smoothed conditional probabilities can be stored in a
+#dense V x V matrix of log-probabilities
+
+
+def letter_alphabet(*uniletter_dicts):
+    #this function takes one or more dicts with the count of letter unigrams
+    #and returns the sorted code points of all letters seen in training
+    #note that the training data can contain lone surrogates (see read_files), hence
+    #code points are extracted by ord() rather than by encoding to utf8
+    letters = set()
+    for uniletter in uniletter_dicts:
+        letters.update(key for key in uniletter if len(key) == 1)
+    return np.array(sorted(ord(letter) for letter in letters), dtype=np.uint32)
+
+
+def letter_id(letter, alphabet):
+    #returns the integer id of a letter (or of a special character)
+    if letter == '<b>':
+        return BEGIN_ID
+    if letter == '<e>':
+        return END_ID
+    pos = int(np.searchsorted(alphabet, ord(letter)))
+    if pos < len(alphabet) and alphabet[pos] == ord(letter):
+        return pos + FIRST_ID
+    return UNKNOWN_ID
+
+
+def letter_count_arrays(uniletter, biletter, alphabet):
+    #this function turns the dicts with the count of letter unigrams and bigrams
+    #into a vector and a matrix indexed by letter ids
+    #letters that were not seen in training by this language keep a count of 0
+    size = len(alphabet) + FIRST_ID
+    unigram_counts = np.zeros(size, dtype=np.int64)
+    bigram_counts = np.zeros((size, size), dtype=np.int64)
+    for key, count in uniletter.items():
+        unigram_counts[letter_id(key, alphabet)] = count
+    for key, count in biletter.items():
+        first, second = key.split(',')
+        bigram_counts[letter_id(first, alphabet), letter_id(second, alphabet)] = count
+    return unigram_counts, bigram_counts
+
+
+def letter_logprob_counts(unigram_counts, bigram_counts):
+    #this function precomputes the add-one smoothed log-probabilities of score_letters
+    #entry [i, j] of the output matrix is the log of the conditional probability of
+    #seeing letter j after letter i
+    #counts can also have an extra last axis with one column per language
+    #V is the size of the vocabulary of the language, exactly as in score_letters,
+    #and it is not the size of the (shared) alphabet
+    V = np.count_nonzero(unigram_counts, axis=0)
+    #unknown letters have a count of 0, which gives the same smoothed values
+    #that score_letters obtains by catching the KeyError
+    return np.log((bigram_counts + 1) / (unigram_counts[:, None] + V))
+
+
+def letter_starts(lines):
+    #returns, for each line (with single spaces between words), the position of its first
+    #letter bigram (or n-gram) among those of all the lines: every word has len(word) + 1
+    return sentence_starts(np.array([len(line) - line.count(' ') + len(line.split()) for line in lines],
+                                    dtype=np.int64))
+
+
+@profiled('encode_letters')
+def encode_letters(sentence_list, alphabet):
+    #this function turns a list of sentences into the ids of all their letter bigrams
+    #every word is padded with a whitespace on both sides: a whitespace is read as <b>
+    #when it is the first letter of a bigram and as <e> when it is the second one
+    #two consecutive whitespaces (between words or between sentences) are not a bigram
+    #returns the ids of the first and second letter of each bigram and, for each
+    #sentence, the position of its first bigram
+    lines = [' '.join(line.split()) for line in sentence_list]
+    text = ''.join(' ' + line + ' ' for line in lines)
+    codes = np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype='<u4')
+    #look up each code point in the sorted alphabet
+    pos = np.searchsorted(alphabet, codes)
+    found = alphabet[np.minimum(pos, len(alphabet) - 1)] == codes
+    ids = np.where(found, pos + FIRST_ID, UNKNOWN_ID)
+    space = codes == ord(' ')
+    first = np.where(space[:-1], BEGIN_ID, ids[:-1])
+    second = np.where(space[1:], END_ID, ids[1:])
+    is_bigram = ~(space[:-1] & space[1:])
+    return first[is_bigram], second[is_bigram], letter_starts(lines)
+
+
+@profiled('score_letters_model')
+def score_letters_model(sentence_list, model):
+    #scores a list of sentences against every language of a trained model (see modelStore)
+    #the log-probabilities of all languages are stored next to each other, hence
+    #sentences are encoded once and a single gather scores them against all languages
+    #returns a matrix with one row per sentence and one column per language
+    first, second, starts = encode_letters(sentence_list, model['letters'])
+    if profiling_enabled():
+        #a bigram (or its first letter) is unknown to a language if its count is 0
+        count_model_lookups('score_letters_model', model['languages'],
+                            model['letter_bigram_counts'][first, second] == 0,
+                            model['letter_unigram_counts'][first] == 0)
+    #int16 log-probabilities are scaled integers (see modelStore.quantize_model)
+    return sum_by_sentence(model['letter_logprob'][first, second], starts) / model.get('letter_scale', 1)
+
+
+def score_letters_early_exit(sentence, model, margin, rate=None, block_size=EARLY_EXIT_BLOCK):
+    #opt-in sequential version of score_letters_model for a single, possibly long, sentence
+    #words are encoded and scored block_size at a time, and scoring stops as soon as
+    #a language leads by margin plus rate per letter bigram left (see early_exit_scores)
+    #by default, rate is the largest gap of the model between two languages for one
+    #bigram, so that the prediction is that of full scoring; a caller that scores many
+    #sentences can compute it once with early_exit_rate_letters
+    #letter bigrams never span two words, hence blocks of words are scored exactly
+    #returns the scores of all languages and the number of letter bigrams scored
+    words = sentence.split()
+    if rate is None:
+        rate = early_exit_rate_letters(model)
+
+    def blocks():
+        for i in range(0, len(words), block_size):
+            first, second, starts = encode_letters([' '.join(words[i:i + block_size])], model['letters'])
+            yield model['letter_logprob'][first, second] / model.get('letter_scale', 1)
+
+    #every word has len(word) + 1 letter bigrams
+    num_bigrams = sum(map(len, words)) + len(words)
+    return early_exit_scores(blocks(), margin, len(model['languages']), num_bigrams, rate)
+
+
+def early_exit_rate_letters(model):
+    #returns the largest gap between the letter log-probabilities of two languages
+    #for a single bigram (see early_exit_scores)
+    return max_log_ratio(model['letter_logprob'], scale=model.get('letter_scale', 1))
+
+
+#the functions below generalize the letter bigram model to letter n-grams of any order
+#from 1 to MAX_ORDER: every word is padded with order - 1 <b> and one <e>, so that a
+#model of any order scores len(word) + 1 n-grams per word, like the bigram model
+#an n-gram is identified by a rolling hash of the ids of its letters: the hash of the
+#n-gram of order j that ends at a position is the hash of the n-gram of order j - 1
+#that ends at the previous position, times the number of ids, plus the id at the
+#position; all orders are therefore computed in one pass, at the cost of one
+#multiply-add per order and per letter
+#hashes are computed modulo 2**64 and give each n-gram its own hash as long as
+#(len(alphabet) + FIRST_ID) ** order < 2**64, eg for alphabets of up to 7000 letters
+#with order 5
+#n-grams are add-one smoothed as in score_letters: the probability of an n-gram is
+#(count(ngram) + 1) / (count(context) + V), where the context is the n-gram without its
+#last letter and V is the size of the vocabulary of letters (including <b> and <e>);
+#with order 2 the scores are those of score_letters
+MAX_ORDER = 5
+#number of lines counted at once by count_letter_ngrams
+NGRAM_BATCH = 1 << 14
+
+
+def ngram_alphabet(*sentence_lists):
+    #returns the sorted code points of all the letters of one or more lists of sentences
+    text = ''.join(''.join(line.split()) for sentence_list in sentence_lists for line in sentence_list)
+    if not text:
+        return np.zeros(0, dtype=np.uint32)
+    return np.unique(np.array([text]).view(np.uint32))
+
+
+@profiled('encode_letter_ngrams')
+def encode_letter_ngrams(sentence_list, alphabet, order):
+    #this function turns a list of sentences into the ids of their letters, with every
+    #word padded with order - 1 <b> and one <e>
+    #returns the ids, the positions of the letters and of the <e>'s, ie of the last
+    #letter of every n-gram, and, for each sentence, the position of its first n-gram
+    lines = [' '.join(line.split()) for line in sentence_list]
+    text = ''.join(' ' + line + ' ' for line in lines)
+    #the code points are read from a numpy string, as the training data can contain
+    #lone surrogates (see letter_alphabet)
+    codes = np.array([text]).view(np.uint32) if text else np.zeros(0, dtype=np.uint32)
+    space = codes == ord(' ')
+    letters = np.flatnonzero(~space)
+    pos = np.searchsorted(alphabet, codes[letters])
+    found = alphabet[np.minimum(pos, len(alphabet) - 1)] == codes[letters]
+    #every word adds order ids (its padding) before the ids of its following words
+    words = np.cumsum(space[letters - 1])
+    positions = np.arange(len(letters)) + order * words - 1
+    ids = np.full(len(letters) + order * (words[-1] if len(words) else 0), BEGIN_ID, dtype=np.int64)
+    ids[positions] = np.where(found, pos + FIRST_ID, UNKNOWN_ID)
+    ids[positions[space[letters + 1]] + 1] = END_ID
+    return ids, np.flatnonzero(ids != BEGIN_ID), letter_starts(lines)
+
+
+def letter_ngram_hashes(ids, base, order):
+    #returns the rolling hashes of the n-grams of orders 1 to order that end at each
+    #position of ids (positions without enough letters before them get partial hashes)
+    hashes = [ids.astype(np.uint64)]
+    base = np.uint64(base)
+    for j in range(1, order):
+        current = hashes[0].copy()
+        current[1:] += hashes[-1][:-1] * base
+        hashes.append(current)
+    return hashes
+
+
+def ngram_batch_counts(sentence_list, alphabet, max_order):
+    #counts the n-grams and the contexts of all orders of a list of sentences
+    #returns a list with, for each order, the sorted hashes of the n-grams and of the
+    #contexts seen and their counts; order 1 has no context
+    ids, last, starts = encode_letter_ngrams(sentence_list, alphabet, max_order)
+    hashes = letter_ngram_hashes(ids, len(alphabet) + FIRST_ID, max_order)
+    tables = []
+    for j in range(max_order):
+        ngrams = np.unique(hashes[j][last], return_counts=True)
+        contexts = np.unique(hashes[j - 1][last - 1], return_counts=True) if j else None
+        tables.append((ngrams, contexts))
+    return tables
+
+
+@profiled('count_letter_ngrams')
+def count_letter_ngrams(sentence_list, alphabet, max_order=MAX_ORDER, batch_size=NGRAM_BATCH):
+    #function to obtain the count of the letter n-grams of all orders from 1 to max_order
+    #in a single pass over a corpus; sentence_list can be any iterable of lines
+    #the alphabet must hold every letter of the corpus (see ngram_alphabet)
+    #lines are encoded and hashed batch_size at a time
+    #returns a dict with, for each order, the sorted hashes of the n-grams and of their
+    #contexts with their counts, and what scoring needs: the alphabet, V and the total
+    #number of n-grams of each order
+    batches = []
+    batch = []
+    for line in sentence_list:
+        batch.append(line)
+        if len(batch) == batch_size:
+            batches.append(ngram_batch_counts(batch, alphabet, max_order))
+            batch = []
+    batches.append(ngram_batch_counts(batch, alphabet, max_order))
+    ngrams = [merge_key_counts([tables[j][0] for tables in batches]) for j in range(max_order)]
+    contexts = [None] + [merge_key_counts([tables[j][1] for tables in batches]) for j in range(1, max_order)]
+    #V counts the letters seen, <b> and <e>, as len(uniletter) in score_letters
+    return {'alphabet': alphabet,
+            'max_order': max_order,
+            'V': int(np.count_nonzero(ngrams[0][0] != END_ID)) + 2,
+            'total': int(ngrams[0][1].sum()),
+            'ngram_keys': [keys for keys, counts in ngrams],
+            'ngram_counts': [counts for keys, counts in ngrams],
+            'context_keys': [None] + [keys for keys, counts in contexts[1:]],
+            'context_counts': [None] + [counts for keys, counts in contexts[1:]]}
+
+
+def lookup_hash_counts(keys, counts, hashes):
+    #returns the count of each hash, 0 for the hashes missing from the sorted keys
+    #counts can also have an extra last axis with one column per language
+    if not len(keys):
+        return np.zeros((len(hashes),) + counts.shape[1:], dtype=np.int64)
+    pos = np.minimum(np.searchsorted(keys, hashes), len(keys) - 1)
+    found = keys[pos] == hashes
+    return np.where(found[:, None] if counts.ndim > 1 else found, counts[pos], 0)
+
+
+@profiled('score_letter_ngrams')
+def score_letter_ngrams(sentence_list, ngram_counts, order):
+    #generalization of score_letters to letter n-grams of the given order, which can be
+    #any order up to the max_order the counts were built with (see count_letter_ngrams)
+    #it takes a list of sentences and returns an array with the score of each sentence
+    #with the counts of several languages (see merge_letter_ngrams), sentences are
+    #encoded and looked up once and the output has one column per language
+    ids, last, starts = encode_letter_ngrams(sentence_list, ngram_counts['alphabet'], order)
+    hashes = letter_ngram_hashes(ids, len(ngram_counts['alphabet']) + FIRST_ID, order)
+    numerator = lookup_hash_counts(ngram_counts['ngram_keys'][order - 1], ngram_counts['ngram_counts'][order - 1],
+                                   hashes[order - 1][last]) + 1
+    if order == 1:
+        context = ngram_counts['total']
+    else:
+        context = lookup_hash_counts(ngram_counts['context_keys'][order - 1],
+                                     ngram_counts['context_counts'][order - 1], hashes[order - 2][last - 1])
+    return sum_by_sentence(np.log(numerator / (context + ngram_counts['V'])), starts)
+
+
+def merge_letter_ngrams(ngram_counts):
+    #merges the counts of several languages, built with the same alphabet and max_order,
+    #into counts with one column per language; ngram_counts maps each language to its counts
+    #as in a trained model (see modelStore), the hashes are shared by all languages
+    languages = list(ngram_counts)
+    tables = list(ngram_counts.values())
+    merged = {'languages': languages,
+              'alphabet': tables[0]['alphabet'],
+              'max_order': tables[0]['max_order'],
+              'V': np.array([counts['V'] for counts in tables]),
+              'total': np.array([counts['total'] for counts in tables]),
+              'ngram_keys': [], 'ngram_counts': [], 'context_keys': [None], 'context_counts': [None]}
+    for kind in ['ngram', 'context']:
+        for j in range(0 if kind == 'ngram' else 1, merged['max_order']):
+            keys = np.unique(np.concatenate([counts[kind + '_keys'][j] for counts in tables]))
+            columns = np.zeros((len(keys), len(languages)), dtype=np.int64)
+            for k, counts in enumerate(tables):
+                columns[np.searchsorted(keys, counts[kind + '_keys'][j]), k] = counts[kind + '_counts'][j]
+            merged[kind + '_keys'].append(keys)
+            merged[kind + '_counts'].append(columns)
+    return merged
+
+
+def train_letter_ngrams(train, max_order=MAX_ORDER):
+    #counts the letter n-grams of several languages with a shared alphabet
+    #train maps each language to its list of sentences; returns the merged counts
+    alphabet = ngram_alphabet(*train.values())
+    return merge_letter_ngrams({language: count_letter_ngrams(lines, alphabet, max_order)
+                                for language, lines in train.items()})
+
+
+def make_output_letter(test, model, cache=None):
+    #this function takes the test sentences and a trained model of any number of
+    #languages and returns a list with the predicted language for each sentence
     #the predicted language is the language that is associated to the highest proba
-    output = []
-    for i in range(len(test)):
-        test_line = test[i]
-        results = {'English': score_letters(test_line, uniletter_dict_eng, biletter_dict_eng),
-                   'Italian': score_letters(test_line, uniletter_dict_ita, biletter_dict_ita),
-                   'French' : score_letters(test_line, uniletter_dict_fra, biletter_dict_fra)}
-        predicted_language = max(results.items(), key=operator.itemgetter(1))[0]
-        output.append('{} {}'.format(i+1, predicted_language))
-    return output
+    #with a scoreCache.ScoreCache of this model, sentences in the cache are not scored again
+    if cache is not None:
+        return make_output(score_cached(test, model, score_letters_model, cache), model['languages'])
+    return make_output(score_letters_model(test, model), model['languages'])
 
 
 def main():
-    #read train data
-    ita = read_files('LangId.train.Italian')
-    fra = read_files('LangId.train.French')
-    eng = read_files('LangId.train.English')
+    #load the trained model of all languages (see modelStore)
+    #the model is trained from the corpora only if it was never saved or if the
+    #corpora changed since; modelStore is imported here because it imports this module
+    from modelStore import load_or_train
+    model = load_or_train()
     #read test data
     test = read_files('LangId.test')
     #read ground truth, ie the solution
-    with open('LangId.sol', 'r') as file:
-        sol = file.readlines()
-        sol = [x.replace('\n', '') for x in sol]
-
-    #create letter unigram counts
-    uniletter_dict_ita = unigram_letter_dict(ita)
-    uniletter_dict_fra = unigram_letter_dict(fra)
-    uniletter_dict_eng = unigram_letter_dict(eng)
-
-    #create letter bigram counts
-    biletter_dict_ita = bigram_letter_dict(ita)
-    biletter_dict_fra = bigram_letter_dict(fra)
-    biletter_dict_eng = bigram_letter_dict(eng)
+    sol = read_solution('LangId.sol')
 
     #create list with predicted languages of all sentences in test data
-    output_letter = make_output_letter(test,
-                       uniletter_dict_eng, biletter_dict_eng,
-                       uniletter_dict_ita, biletter_dict_ita,
-                       uniletter_dict_fra, biletter_dict_fra)
+    output_letter = make_output_letter(test, model)
 
     #write output to file
     write_out('letterLangId.out', output_letter)
@@ -161,6 +456,10 @@ def main():
     perf = compute_performance(output_letter, sol)
     print('Accuracy of letter bigram model with add-one smoothing: {}%'.format(perf))
 
+    #write the profile to the standard error if profiling is on (see profiler)
+    if profiling_enabled():
+        dump_profile()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,760 @@
+from support import stream_lines, shard_ranges, normalize_lines, CHUNK_SIZE, BEGIN_ID, END_ID, UNKNOWN_ID, FIRST_ID
+from support import read_files
+from letterLangId import letter_alphabet, letter_count_arrays, letter_logprob_counts, score_letters_model
+from wordLangId import count_word_store, merge_word_stores, store_predecessors, lookup_bigrams
+from wordLangId import addone_logprob_arrays, score_words_model
+from wordLangId2 import gt_logprob_arrays, gt_log_table, dense_threshold, update_threshold
+from wordLangId2 import score_words_gt_model
+from profiler import profiled, profiling_enabled, count, dump_profile
+import numpy as np
+import argparse
+import glob
+import json
+import os
+import sys
+import tempfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+#a trained model holds the counts and the smoothed log-probabilities of the three
+#language models for any number of languages, with letters and words interned to
+#integer ids; the same letter and word ids are shared by all languages
+#every array has a last axis with one column per language, in the order given by
+#model['languages']: the values of all languages for a given bigram are next to each
+#other, so that a sentence is scored against all languages with a single gather
+#training corpora are the files named TRAIN_PREFIX + language
+TRAIN_PREFIX = 'LangId.train.'
+MODEL_FILE = 'LangId.model'
+#size of the shards in which corpora are split for parallel training
+SHARD_SIZE = 64 << 20
+
+#the three language models of a trained model, with the function that scores a batch of
+#lines against all languages (one row per line and one column per language)
+SCORERS = {'letter': score_letters_model,
+           'word': score_words_model,
+           'word_gt': score_words_gt_model}
+
+#on disk, a model is a small json header followed by the raw arrays
+#the file starts with MAGIC and with the length of the header (8 bytes, little endian)
+#every array starts at a multiple of ALIGNMENT, so that it can be memory mapped
+MAGIC = b'LANGID\x00\x03'
+ALIGNMENT = 64
+#names of the arrays stored in a model file
+ARRAYS = ['letters', 'letter_unigram_counts', 'letter_bigram_counts', 'letter_logprob',
+          'word_unigram_counts', 'bigram_offsets', 'bigram_successors', 'word_bigram_counts',
+          'addone_bigram_logprob', 'addone_unseen_logprob',
+          'gt_bigram_logprob', 'gt_unseen_logprob']
+#values of a model (json types) kept in the header of its file, eg the thresholds of
+#the cascade of models (see cascadeLangId.load_thresholds)
+METADATA = ['cascade_thresholds']
+#smoothed log-probabilities that a model can store in a smaller type (see quantize_model),
+#grouped by language model: the tables of a group are summed together and share a scale
+QUANTIZED = {'letter': ['letter_logprob'],
+             'addone': ['addone_bigram_logprob', 'addone_unseen_logprob'],
+             'gt': ['gt_bigram_logprob', 'gt_unseen_logprob']}
+#largest magnitude of an int16 log-probability
+INT16_MAX = np.iinfo(np.int16).max
+
+
+@profiled('compile_model')
+def compile_model(counts):
+    #this function builds a trained model from the python dicts with the counts
+    #counts maps each language to a dict with keys 'uniletter', 'biletter' (see the
+    #*_dict functions of the letter model) and 'words' (see wordLangId.count_word_store)
+    languages = list(counts)
+    letters = letter_alphabet(*[counts[lang]['uniletter'] for lang in languages])
+    letter_counts = [letter_count_arrays(counts[lang]['uniletter'], counts[lang]['biletter'], letters)
+                     for lang in languages]
+    store = merge_word_stores([counts[lang]['words'] for lang in languages])
+    model = {'languages': languages,
+             'letters': letters,
+             'letter_unigram_counts': np.stack([uni for uni, bi in letter_counts], axis=-1),
+             'letter_bigram_counts': np.stack([bi for uni, bi in letter_counts], axis=-1),
+             'words': store['words'],
+             'word_ids': vocabulary(store['words']),
+             'word_unigram_counts': store['unigram_counts'],
+             'bigram_offsets': store['offsets'],
+             'bigram_successors': store['successors'],
+             'word_bigram_counts': store['counts']}
+    return smooth_model(model)
+
+
+def vocabulary(words):
+    #returns the dict that maps each word of a model (and the special characters) to its id
+    word_ids = dict(zip(words, range(FIRST_ID, FIRST_ID + len(words))))
+    word_ids['<b>'] = BEGIN_ID
+    word_ids['<e>'] = END_ID
+    return word_ids
+
+
+@profiled('smooth_model')
+def smooth_model(model):
+    #this function (re)computes the smoothed log-probabilities of a model from its counts
+    #add-one smoothing is computed for all languages at once
+    model['letter_logprob'] = letter_logprob_counts(model['letter_unigram_counts'],
+                                                    model['letter_bigram_counts'])
+    first = store_predecessors(model['bigram_offsets'])
+    model['addone_bigram_logprob'], model['addone_unseen_logprob'] = addone_logprob_arrays(
+        model['word_unigram_counts'], model['word_bigram_counts'], first)
+    #GT smoothing needs the frequencies of frequencies of each language
+    arrays = [gt_logprob_arrays(model['word_unigram_counts'][:, k], model['word_bigram_counts'][:, k], first)
+              for k in range(len(model['languages']))]
+    model['gt_bigram_logprob'] = np.stack([bigram for bigram, unseen in arrays], axis=-1)
+    model['gt_unseen_logprob'] = np.stack([unseen for bigram, unseen in arrays], axis=-1)
+    return model
+
+
+#a trained model can be updated with new lines of one language (see update_model)
+#smoothing needs, for each language, the vocabulary size V, the totals and the Nx's of
+#the word counts and the GT thresholds; those are kept in model['word_statistics'] and
+#updated with the counts of the new lines only, ie without sorting all the Nx's again
+#or scanning them for the threshold
+#statistics are not saved with the model: they are computed from the counts the first
+#time a model is updated
+
+
+def word_statistics(unigram_counts, bigram_counts):
+    #computes the statistics of the word counts of one language (see above)
+    #Nx's are arrays indexed by count; N(0) is not stored (see turing_smoothing_nx)
+    unigram_nx = np.bincount(unigram_counts)
+    bigram_nx = np.bincount(bigram_counts)
+    unigram_nx[0] = bigram_nx[0] = 0
+    return {'V': int(np.count_nonzero(unigram_counts)),
+            'bigram_types': int(np.count_nonzero(bigram_counts)),
+            'unigram_total': int(unigram_counts.sum()),
+            'bigram_total': int(bigram_counts.sum()),
+            'unigram_nx': unigram_nx,
+            'bigram_nx': bigram_nx,
+            'unigram_threshold': dense_threshold(unigram_nx),
+            'bigram_threshold': dense_threshold(bigram_nx),
+            'stale': False}
+
+
+def update_statistics(statistics, kind, old, new):
+    #updates the statistics of unigrams or bigrams (kind) given the old and new counts
+    #of the tokens of a batch; it costs time proportional to the size of the batch
+    #counts can go down as well (see subtract_counts)
+    if not len(new):
+        return
+    nx = statistics[kind + '_nx']
+    if new.max() >= len(nx):
+        nx = np.concatenate((nx, np.zeros(new.max() + 1 - len(nx), dtype=nx.dtype)))
+    np.subtract.at(nx, old[old > 0], 1)
+    np.add.at(nx, new[new > 0], 1)
+    statistics[kind + '_nx'] = nx
+    statistics[kind + '_total'] += int((new - old).sum())
+    statistics[kind + '_threshold'] = update_threshold(
+        nx, statistics[kind + '_threshold'], np.union1d(old, new).tolist())
+    seen = int(np.count_nonzero((old == 0) & (new > 0))) - int(np.count_nonzero((old > 0) & (new == 0)))
+    statistics['V' if kind == 'unigram' else 'bigram_types'] += seen
+
+
+def gt_tables(statistics, unigram_size, bigram_size):
+    #returns the GT smoothed log-probabilities of the unigram and bigram counts of a
+    #language, for all counts below unigram_size and bigram_size respectively
+    #N(0) is set as in turing_smoothing_nx
+    unigram_nx = statistics['unigram_nx'].tolist()
+    bigram_nx = statistics['bigram_nx'].tolist()
+    unigram_nx[0] = 1
+    bigram_nx[0] = statistics['V'] ** 2 - statistics['bigram_types']
+    return (gt_log_table(unigram_nx, statistics['unigram_threshold'], statistics['unigram_total'],
+                         unigram_size),
+            gt_log_table(bigram_nx, statistics['bigram_threshold'], statistics['bigram_total'],
+                         bigram_size))
+
+
+def smooth_language(model, k):
+    #recomputes the smoothed word log-probabilities of the k-th language of a model
+    #from its counts and statistics; the result is the same as with smooth_model
+    statistics = model['word_statistics'][k]
+    unigram_counts = model['word_unigram_counts'][:, k]
+    bigram_counts = model['word_bigram_counts'][:, k]
+    first = store_predecessors(model['bigram_offsets'])
+    V = statistics['V']
+    model['addone_bigram_logprob'][:, k] = np.log((bigram_counts + 1) / (unigram_counts[first] + V))
+    model['addone_unseen_logprob'][:, k] = np.log(1 / (unigram_counts + V))
+    unigram_log, bigram_log = gt_tables(statistics, unigram_counts.max() + 1, bigram_counts.max() + 1)
+    model['gt_bigram_logprob'][:, k] = bigram_log[bigram_counts] - unigram_log[unigram_counts[first]]
+    model['gt_unseen_logprob'][:, k] = bigram_log[0] - unigram_log[unigram_counts]
+    statistics['stale'] = False
+
+
+def smooth_updates(model):
+    #adds the counts of the lines queued by update_model with smooth=False, all the
+    #batches of a language at once, and recomputes the smoothed word log-probabilities
+    #of the languages that were updated
+    for language, partial_counts in model.pop('pending_counts', {}).items():
+        add_counts(model, language, merge_counts(partial_counts))
+    for k, statistics in enumerate(model.get('word_statistics', [])):
+        if statistics['stale']:
+            smooth_language(model, k)
+    return model
+
+
+def add_language(model, language):
+    #adds a language without any count to a model: every array gets a column of zeros
+    for name in ARRAYS:
+        if name not in ['letters', 'bigram_offsets', 'bigram_successors']:
+            zeros = np.zeros(model[name].shape[:-1] + (1,), dtype=model[name].dtype)
+            model[name] = np.concatenate((model[name], zeros), axis=-1)
+    model['languages'] = model['languages'] + [language]
+    model['word_statistics'].append(word_statistics(model['word_unigram_counts'][:, -1],
+                                                    model['word_bigram_counts'][:, -1]))
+
+
+def update_letters(model, k, uniletter, biletter):
+    #adds the letter counts of a batch to the k-th language of a model
+    #letters that were never seen are inserted in the sorted alphabet; all the letter
+    #arrays have the size of the alphabet, hence this does not depend on the corpora
+    letters = np.union1d(model['letters'], letter_alphabet(uniletter)).astype(model['letters'].dtype)
+    if len(letters) > len(model['letters']):
+        #ids of the old letters in the new alphabet
+        ids = np.concatenate(([BEGIN_ID, END_ID, UNKNOWN_ID],
+                              np.searchsorted(letters, model['letters']) + FIRST_ID))
+        size = len(letters) + FIRST_ID
+        L = len(model['languages'])
+        unigram_counts = np.zeros((size, L), dtype=np.int64)
+        bigram_counts = np.zeros((size, size, L), dtype=np.int64)
+        unigram_counts[ids] = model['letter_unigram_counts']
+        bigram_counts[np.ix_(ids, ids)] = model['letter_bigram_counts']
+        model['letters'] = letters
+        model['letter_unigram_counts'] = unigram_counts
+        model['letter_bigram_counts'] = bigram_counts
+    unigram_counts, bigram_counts = letter_count_arrays(uniletter, biletter, model['letters'])
+    model['letter_unigram_counts'][:, k] += unigram_counts
+    model['letter_bigram_counts'][:, :, k] += bigram_counts
+    model['letter_logprob'] = letter_logprob_counts(model['letter_unigram_counts'],
+                                                    model['letter_bigram_counts'])
+
+
+def update_words(model, k, store):
+    #adds the word counts of a batch (a store, see count_word_store) to the k-th language
+    #of a model
+    #new words get the next free ids, ie rows at the end of the arrays, and the ids of
+    #the other words do not change; new bigrams are inserted among the successors of
+    #their first word and, for the other languages, their log-probabilities are those
+    #of an unseen bigram
+    word_ids = model['word_ids']
+    old_U = len(model['bigram_offsets']) - 1
+    for word in store['words']:
+        if word not in word_ids:
+            word_ids[word] = len(model['words']) + FIRST_ID
+            model['words'].append(word)
+    U = len(model['words']) + FIRST_ID
+    if U > old_U:
+        #rows of the new words: no successor, counts of 0 and the log-probabilities
+        #of a word never seen by each language
+        new_rows = U - old_U
+        model['bigram_offsets'] = np.concatenate(
+            (model['bigram_offsets'], np.full(new_rows, model['bigram_offsets'][-1])))
+        model['word_unigram_counts'] = np.concatenate(
+            (model['word_unigram_counts'], np.zeros((new_rows, len(model['languages'])), dtype=np.int64)))
+        addone_unseen = []
+        gt_unseen = []
+        for statistics in model['word_statistics']:
+            #a language without counts (see add_language) is smoothed after the update
+            if not statistics['V']:
+                addone_unseen.append(0)
+                gt_unseen.append(0)
+                continue
+            unigram_log, bigram_log = gt_tables(statistics, 1, 1)
+            addone_unseen.append(np.log(1 / statistics['V']))
+            gt_unseen.append(bigram_log[0] - unigram_log[0])
+        for name, values in [('addone_unseen_logprob', addone_unseen), ('gt_unseen_logprob', gt_unseen)]:
+            model[name] = np.concatenate((model[name], np.tile(values, (new_rows, 1))))
+    #ids of the batch in the model
+    ids = np.array([BEGIN_ID, END_ID, UNKNOWN_ID] + [word_ids[word] for word in store['words']], dtype=np.int64)
+    #unigram counts
+    old = model['word_unigram_counts'][ids, k]
+    new = old + store['unigram_counts']
+    model['word_unigram_counts'][ids, k] = new
+    update_statistics(model['word_statistics'][k], 'unigram', old, new)
+    #bigram counts
+    first = ids[store_predecessors(store['offsets'])]
+    second = ids[store['successors']]
+    pos, found = lookup_bigrams(first, second, model['bigram_offsets'], model['bigram_successors'])
+    if not found.all():
+        #np.insert keeps the order of the values inserted at the same position, hence
+        #new bigrams are sorted by first and then by second id
+        order = np.lexsort((second[~found], first[~found]))
+        at = pos[~found][order]
+        new_first = first[~found][order]
+        model['bigram_successors'] = np.insert(model['bigram_successors'], at, second[~found][order])
+        model['bigram_offsets'] = model['bigram_offsets'] + np.concatenate(
+            ([0], np.cumsum(np.bincount(new_first, minlength=U))))
+        model['word_bigram_counts'] = np.insert(model['word_bigram_counts'], at, 0, axis=0)
+        for smoothing in ['addone', 'gt']:
+            model[smoothing + '_bigram_logprob'] = np.insert(
+                model[smoothing + '_bigram_logprob'], at, model[smoothing + '_unseen_logprob'][new_first], axis=0)
+        pos, found = lookup_bigrams(first, second, model['bigram_offsets'], model['bigram_successors'])
+    old = model['word_bigram_counts'][pos, k]
+    new = old + store['counts']
+    model['word_bigram_counts'][pos, k] = new
+    update_statistics(model['word_statistics'][k], 'bigram', old, new)
+    model['word_statistics'][k]['stale'] = True
+
+
+def make_updatable(model):
+    #prepares a model for in-place updates
+    #arrays memory mapped by load_model are read-only: they are copied on the first update
+    #quantized models only serve for scoring, as smoothing needs full precision
+    if model['letter_logprob'].dtype != np.float64:
+        raise ValueError('a quantized model cannot be updated: update the full model and quantize it again')
+    for name in ARRAYS:
+        if not model[name].flags.writeable:
+            model[name] = np.array(model[name])
+    model['words'] = list(model['words'])
+    if 'word_statistics' not in model:
+        model['word_statistics'] = [word_statistics(model['word_unigram_counts'][:, k],
+                                                    model['word_bigram_counts'][:, k])
+                                    for k in range(len(model['languages']))]
+
+
+def copy_model(model):
+    #returns a copy of a model that can be updated without changing the original
+    make_updatable(model)
+    copy = dict(model)
+    for name in ARRAYS:
+        copy[name] = model[name].copy()
+    copy['words'] = list(model['words'])
+    copy['word_ids'] = dict(model['word_ids'])
+    if 'pending_counts' in model:
+        copy['pending_counts'] = {language: list(counts) for language, counts in model['pending_counts'].items()}
+    copy['word_statistics'] = [dict(statistics, unigram_nx=statistics['unigram_nx'].copy(),
+                                    bigram_nx=statistics['bigram_nx'].copy())
+                               for statistics in model['word_statistics']]
+    return copy
+
+
+@profiled('subtract_counts')
+def subtract_counts(model, language, counts):
+    #removes from a model, in place, the counts of lines of a language that the model
+    #was trained on; counts are those of count_corpus
+    #this is update_model with negated counts: the counts and the statistics of the
+    #words that changed are updated, and words and bigrams whose count drops to 0 are
+    #kept, with the log-probabilities of unknowns once smoothed
+    #the smoothed word log-probabilities are recomputed by smooth_updates(model)
+    make_updatable(model)
+    k = model['languages'].index(language)
+    update_letters(model, k, Counter({key: -value for key, value in counts['uniletter'].items()}),
+                   Counter({key: -value for key, value in counts['biletter'].items()}))
+    words = counts['words']
+    update_words(model, k, dict(words, unigram_counts=-words['unigram_counts'], counts=-words['counts']))
+    return model
+
+
+@profiled('prune_model')
+def prune_model(model, min_count=1, drop_fraction=0.0):
+    #returns a smaller copy of a trained model, for faster scoring and a smaller file
+    #with min_count, letters and words seen fewer than min_count times in every language
+    #are dropped (they become unknowns) and so are, for each language, the letter and
+    #word bigrams seen fewer than min_count times
+    #with drop_fraction, that fraction of the word bigrams left (over all languages) is
+    #dropped as well, those whose removal changes the add-one model the least: a bigram
+    #contributes P(w1, w2) * (log P(w2|w1) - log P_unseen(w2|w1)) to the relative
+    #entropy between the full and the pruned model
+    #a dropped bigram gets the log-probability of an unseen bigram; bigrams dropped by
+    #every language are removed from the store
+    #smoothing is recomputed (see smooth_language) so that V is the number of words
+    #kept and pruned bigrams count as unseen in the N(0) of GT smoothing; the other Nx's
+    #and the totals stay those of the training counts, as counts below min_count no
+    #longer exist and GT would otherwise give unseen bigrams a probability of 0
+    make_updatable(model)
+    L = len(model['languages'])
+    pruned = {'languages': model['languages']}
+    #letters: the matrix of letter bigrams is dense, only dropping letters shrinks it
+    keep = (model['letter_unigram_counts'] >= min_count).any(axis=1)
+    keep[:FIRST_ID] = True
+    letter_bigram_counts = model['letter_bigram_counts'][np.ix_(keep, keep)]
+    pruned['letters'] = model['letters'][keep[FIRST_ID:]]
+    pruned['letter_unigram_counts'] = model['letter_unigram_counts'][keep]
+    pruned['letter_bigram_counts'] = np.where(letter_bigram_counts >= min_count, letter_bigram_counts, 0)
+    pruned['letter_logprob'] = letter_logprob_counts(pruned['letter_unigram_counts'],
+                                                     pruned['letter_bigram_counts'])
+    #words
+    keep = (model['word_unigram_counts'] >= min_count).any(axis=1)
+    keep[:FIRST_ID] = True
+    first = store_predecessors(model['bigram_offsets'])
+    second = model['bigram_successors']
+    counts = np.where(model['word_bigram_counts'] >= min_count, model['word_bigram_counts'], 0)
+    counts[~(keep[first] & keep[second])] = 0
+    seen = np.flatnonzero(counts)
+    dropped = int(len(seen) * drop_fraction)
+    if dropped:
+        probability = counts / np.maximum(counts.sum(axis=0), 1)
+        contribution = probability * (model['addone_bigram_logprob'] - model['addone_unseen_logprob'][first])
+        counts.ravel()[seen[np.argpartition(contribution.ravel()[seen], dropped - 1)[:dropped]]] = 0
+    kept = counts.any(axis=1)
+    #new ids of the words kept, which stay in the same order: bigrams stay sorted
+    ids = np.cumsum(keep) - 1
+    pruned['words'] = [word for word, k in zip(model['words'], keep[FIRST_ID:].tolist()) if k]
+    pruned['word_ids'] = vocabulary(pruned['words'])
+    pruned['word_unigram_counts'] = model['word_unigram_counts'][keep]
+    pruned['bigram_offsets'] = np.concatenate(
+        ([0], np.cumsum(np.bincount(ids[first[kept]], minlength=np.count_nonzero(keep)))))
+    pruned['bigram_successors'] = ids[second[kept]].astype(second.dtype)
+    pruned['word_bigram_counts'] = counts[kept]
+    #smoothing
+    #V and bigram_types are those of the pruned counts, but the Nx's and totals are
+    #copied unchanged from the training counts on purpose (see above); they are copied
+    #so that updating the pruned model does not change the statistics of the model
+    pruned['word_statistics'] = []
+    for k, statistics in enumerate(model['word_statistics']):
+        pruned['word_statistics'].append(dict(
+            statistics, V=int(np.count_nonzero(pruned['word_unigram_counts'][:, k])),
+            bigram_types=int(np.count_nonzero(pruned['word_bigram_counts'][:, k])),
+            unigram_nx=statistics['unigram_nx'].copy(), bigram_nx=statistics['bigram_nx'].copy()))
+    for smoothing in ['addone', 'gt']:
+        pruned[smoothing + '_bigram_logprob'] = np.zeros((len(pruned['bigram_successors']), L))
+        pruned[smoothing + '_unseen_logprob'] = np.zeros((len(pruned['word_unigram_counts']), L))
+    for k in range(L):
+        smooth_language(pruned, k)
+    count('prune_model.bigrams', len(second) - len(pruned['bigram_successors']))
+    return pruned
+
+
+@profiled('quantize_model')
+def quantize_model(model, dtype):
+    #returns a copy of a trained model whose smoothed log-probabilities are stored as
+    #float32 or int16 (dtype) instead of float64, which makes the tables 2 or 4 times
+    #smaller and helps the gathers of batch scoring stay in the CPU cache
+    #tables keep their layout, with the values of all languages of a bigram next to each
+    #other; int16 values are the log-probabilities times a scale, one per language and
+    #group of tables (see QUANTIZED), chosen so that the largest magnitude of the group
+    #is INT16_MAX; scorers divide their sums by model[group + '_scale']
+    #scores are summed in float64 or int64 (see sum_by_sentence): the drift of a score
+    #is at most half a step of the scale per bigram for int16 (see verify_quantization)
+    dtype = np.dtype(dtype)
+    if dtype not in [np.float32, np.int16]:
+        raise ValueError('log-probabilities can only be quantized to float32 or int16, not {}'.format(dtype))
+    #int16 tables are scaled per language: casting them again would mix the scales
+    if any(model[name].dtype != np.float64 for names in QUANTIZED.values() for name in names):
+        raise ValueError('only a full precision (float64) model can be quantized')
+    quantized = dict(model)
+    for group, names in QUANTIZED.items():
+        quantized.pop(group + '_scale', None)
+        if dtype == np.int16:
+            largest = np.max([np.abs(model[name]).reshape(-1, len(model['languages'])).max(axis=0, initial=0)
+                              for name in names], axis=0)
+            scale = INT16_MAX / np.maximum(largest, np.finfo(np.float64).tiny)
+            quantized[group + '_scale'] = scale
+            for name in names:
+                quantized[name] = np.ascontiguousarray(np.rint(model[name] * scale).astype(np.int16))
+        else:
+            for name in names:
+                quantized[name] = np.ascontiguousarray(model[name], dtype=np.float32)
+    return quantized
+
+
+def verify_quantization(model, quantized, sentence_list):
+    #scores sentences with the three language models of a full precision model and of
+    #its quantized copy (see quantize_model)
+    #returns, for each language model, the number of sentences whose predicted language
+    #changed and the largest and mean absolute drift of the scores
+    results = {}
+    for name, scorer in SCORERS.items():
+        scores = scorer(sentence_list, model)
+        quantized_scores = scorer(sentence_list, quantized)
+        drift = np.abs(quantized_scores - scores)
+        changed = np.argmax(scores, axis=1) != np.argmax(quantized_scores, axis=1)
+        results[name] = {'changed': int(np.count_nonzero(changed)),
+                         'max_drift': float(drift.max(initial=0)),
+                         'mean_drift': float(drift.mean()) if drift.size else 0.0}
+    return results
+
+
+@profiled('update_model')
+def update_model(model, language, lines, smooth=True):
+    #adds the counts of new training lines of a language to a trained model and returns
+    #the model, which is updated in place; the language is added if it is new
+    #lines are raw lines, cleaned as the training corpora (see stream_lines)
+    #the counts, the alphabet, the vocabulary and the statistics of the word counts are
+    #updated with the counts of the new lines only (see add_counts)
+    #this still costs time proportional to the size of the model: new words and bigrams
+    #are inserted in the arrays of the model, which copies them, and the smoothed word
+    #log-probabilities of a language all depend on its totals, hence they are recomputed
+    #for the updated language (with vectorized operations)
+    #with smooth=False, the lines are only counted and their counts queued until
+    #smooth_updates(model) is called, which adds the counts of all the queued batches
+    #of a language at once: a series of small updates then costs time proportional to
+    #the size of the updates, plus a single update of the model; the model does not
+    #include the queued lines until then
+    #a new language must come with at least one line that is not empty once cleaned:
+    #a language without any count would get a vocabulary of size 0, and infinite
+    #scores that win every prediction
+    make_updatable(model)
+    counts = count_corpus(filter(None, normalize_lines(list(lines))))
+    if (not counts['words']['unigram_counts'][BEGIN_ID] and language not in model['languages']
+            and language not in model.get('pending_counts', {})):
+        raise ValueError('no line of the new language {} is left once cleaned'.format(language))
+    if not smooth:
+        model.setdefault('pending_counts', {}).setdefault(language, []).append(counts)
+        return model
+    smooth_language(model, add_counts(model, language, counts))
+    return model
+
+
+def add_counts(model, language, counts):
+    #adds counts (see count_corpus) to a language of a model, which is added if it is
+    #new, and returns the index of the language; the smoothed word log-probabilities
+    #of the language are then stale (see smooth_updates)
+    make_updatable(model)
+    if language not in model['languages']:
+        add_language(model, language)
+    k = model['languages'].index(language)
+    update_letters(model, k, counts['uniletter'], counts['biletter'])
+    update_words(model, k, counts['words'])
+    return k
+
+
+@profiled('count_corpus')
+def count_corpus(lines):
+    #this function counts the letter and word unigrams and bigrams of a corpus in a
+    #single pass over its lines; lines can be any iterable, eg the stream_lines generator,
+    #so that memory usage depends on the size of the model and not of the corpus
+    #the counts are identical to those of the *_dict functions of the language models;
+    #word counts are kept in a store (see wordLangId.count_word_store)
+    uniletter = Counter()
+    biletter = Counter()
+    num_words = 0
+
+    def count_letters(lines):
+        #counts the letters of each line on its way to count_word_store
+        nonlocal num_words
+        for line in lines:
+            words = line.split()
+            num_words += len(words)
+            #letter unigrams and bigrams, with <b> and <e> at the beginning and end of word
+            for one_word in words:
+                uniletter.update(one_word)
+                padded = ['<b>'] + list(one_word) + ['<e>']
+                biletter.update([first + ',' + second for first, second in zip(padded, padded[1:])])
+            yield line
+
+    words = count_word_store(count_letters(lines))
+    uniletter['<b>'] = num_words
+    uniletter['<e>'] = num_words
+    count('count_corpus.lines', words['unigram_counts'][BEGIN_ID])
+    return {'uniletter': uniletter, 'biletter': biletter, 'words': words}
+
+
+def count_shard(path, start, end, chunk_size=CHUNK_SIZE):
+    #counts the unigrams and bigrams of a byte range of a corpus (see shard_ranges)
+    #this function runs in the worker processes of train_model
+    return count_corpus(stream_lines(path, chunk_size, start, end))
+
+
+@profiled('merge_counts')
+def merge_counts(partial_counts):
+    #this function merges the counts of several shards of the same corpus
+    #every table (including the counts of <b> and <e>) is additive, hence merging
+    #is just a sum; the frequencies of frequencies needed by GT smoothing (Nx's) are
+    #not additive and are instead computed from the merged counts by compile_model
+    partial_counts = list(partial_counts)
+    merged = {'uniletter': Counter(), 'biletter': Counter()}
+    for counts in partial_counts:
+        for name in merged:
+            merged[name].update(counts[name])
+    #a corpus without any line still has a count of 0 for the special characters
+    merged['uniletter']['<b>'] += 0
+    merged['uniletter']['<e>'] += 0
+    #the stores of the shards are summed in a single column
+    words = merge_word_stores([counts['words'] for counts in partial_counts], [0] * len(partial_counts))
+    merged['words'] = dict(words, unigram_counts=words['unigram_counts'][:, 0], counts=words['counts'][:, 0])
+    return merged
+
+
+def discover_train_files(directory='.'):
+    #returns a dict that maps each language to its training corpus, ie to each file
+    #named TRAIN_PREFIX + language in directory; languages are sorted by name
+    paths = sorted(glob.glob(os.path.join(glob.escape(directory), TRAIN_PREFIX + '*')))
+    if not paths:
+        raise FileNotFoundError('no {}* corpus found in {}'.format(TRAIN_PREFIX, os.path.abspath(directory)))
+    return {os.path.basename(path)[len(TRAIN_PREFIX):]: path for path in paths}
+
+
+@profiled('train_model')
+def train_model(train_files=None, chunk_size=CHUNK_SIZE, workers=1, shard_size=SHARD_SIZE):
+    #reads the training corpora (one file per language) and returns a trained model
+    #each corpus is streamed in chunks of chunk_size bytes and counted in a single pass
+    #with workers > 1, corpora are split in shards of about shard_size bytes which are
+    #counted in parallel by a pool of processes; the counts of the shards are then merged
+    #by default, the model is trained on all the corpora found by discover_train_files
+    if train_files is None:
+        train_files = discover_train_files()
+    if not train_files:
+        raise ValueError('a model needs at least one {}* corpus'.format(TRAIN_PREFIX))
+    if workers == 1:
+        counts = {language: count_corpus(stream_lines(path, chunk_size))
+                  for language, path in train_files.items()}
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            #shards of all languages are submitted together to keep all the workers busy
+            futures = {language: [pool.submit(count_shard, path, start, end, chunk_size)
+                                  for start, end in shard_ranges(path, shard_size)]
+                       for language, path in train_files.items()}
+            counts = {language: merge_counts(future.result() for future in shard_futures)
+                      for language, shard_futures in futures.items()}
+    #a language without any line would break smoothing (see update_model)
+    for language, path in train_files.items():
+        if not counts[language]['words']['unigram_counts'][BEGIN_ID]:
+            raise ValueError('the {} corpus {} has no line left once cleaned'.format(language, path))
+    return compile_model(counts)
+
+
+def file_signature(path):
+    #size and modification time of a file, used to detect stale models
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+@profiled('save_model')
+def save_model(model, path=MODEL_FILE, train_files=None):
+    #writes a trained model to a binary file
+    #words are stored as a single utf8 blob, one word per line; the surrogateescape
+    #error handler restores the undecodable bytes of the training data (see read_files)
+    #if train_files is given, the signature of the training corpora is stored as well
+    #quantized models (see quantize_model) also store the scales of their int16 tables
+    names = ARRAYS + [group + '_scale' for group in QUANTIZED if group + '_scale' in model]
+    arrays = {name: np.ascontiguousarray(model[name]) for name in names}
+    words = '\n'.join(model['words']).encode('utf8', 'surrogateescape')
+    arrays['words'] = np.frombuffer(words, dtype=np.uint8)
+    header = {'languages': model['languages'], 'arrays': {}, 'sources': {}}
+    header.update({name: model[name] for name in METADATA if name in model})
+    if train_files is not None:
+        header['sources'] = {language: [train_file, file_signature(train_file)]
+                             for language, train_file in train_files.items()}
+    #the header must hold the offset of every array, and those offsets depend on the
+    #length of the header: offsets are therefore relative to the end of the header
+    offsets = {}
+    offset = 0
+    for name, array in arrays.items():
+        offsets[name] = offset
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += aligned(array.nbytes)
+    header = json.dumps(header).encode('utf8')
+    #the arrays start right after the header, at a multiple of ALIGNMENT
+    start = aligned(len(MAGIC) + 8 + len(header))
+    #the model is written to a temporary file that then replaces path: processes that
+    #memory mapped the old file (see load_model) keep reading it, as it is never rewritten
+    descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        #mkstemp creates the file readable by its owner only, open() would follow the umask
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_path, 0o666 & ~umask)
+        with open(descriptor, 'wb') as file:
+            file.write(MAGIC)
+            file.write(len(header).to_bytes(8, 'little'))
+            file.write(header)
+            for name, array in arrays.items():
+                file.seek(start + offsets[name])
+                file.write(array.tobytes())
+            file.truncate(start + offset)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def aligned(size):
+    #rounds size up to the next multiple of ALIGNMENT
+    return -(-size // ALIGNMENT) * ALIGNMENT
+
+
+def read_header(path):
+    #returns the header of a model file and the position of its first array
+    with open(path, 'rb') as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a language model file of the current version'.format(path))
+        size = int.from_bytes(file.read(8), 'little')
+        header = json.loads(file.read(size).decode('utf8'))
+    start = aligned(len(MAGIC) + 8 + size)
+    return header, start
+
+
+@profiled('load_model')
+def load_model(path=MODEL_FILE, mmap=True):
+    #reads a trained model from a binary file
+    #with mmap=True the arrays are read-only views of a memory mapped file: loading
+    #takes constant time and processes that load the same file share its pages
+    #only the vocabulary of words is turned back into a python dict
+    header, start = read_header(path)
+    if mmap:
+        buffer = np.memmap(path, dtype=np.uint8, mode='r')
+    else:
+        with open(path, 'rb') as file:
+            buffer = np.frombuffer(file.read(), dtype=np.uint8)
+    model = {'languages': header['languages'], 'sources': header['sources']}
+    model.update({name: header[name] for name in METADATA if name in header})
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        begin = start + spec['offset']
+        nbytes = int(np.prod(spec['shape'])) * dtype.itemsize
+        model[name] = buffer[begin:begin + nbytes].view(dtype).reshape(spec['shape'])
+    words = model.pop('words').tobytes().decode('utf8', 'surrogateescape')
+    model['words'] = words.split('\n') if words else []
+    model['word_ids'] = vocabulary(model['words'])
+    return model
+
+
+def is_stale(path, train_files):
+    #a model is stale if it was trained on different corpora or if they changed since
+    #files written with an older layout of the arrays are stale as well
+    try:
+        header, start = read_header(path)
+    except ValueError:
+        return True
+    sources = {language: [train_file, file_signature(train_file)]
+               for language, train_file in train_files.items()}
+    return header['sources'] != sources
+
+
+@profiled('load_or_train')
+def load_or_train(path=MODEL_FILE, train_files=None):
+    #loads the model saved in path or, if it is missing or stale, trains a new model
+    #from the training corpora and saves it in path for the following runs
+    #by default, the model covers all the corpora found by discover_train_files
+    if train_files is None:
+        train_files = discover_train_files()
+    if os.path.exists(path) and not is_stale(path, train_files):
+        return load_model(path)
+    model = train_model(train_files)
+    save_model(model, path, train_files)
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Trains the three language models and saves them')
+    parser.add_argument('--quantize', choices=['float32', 'int16'],
+                        help='type of the smoothed log-probabilities (default: float64)')
+    parser.add_argument('--no-verify', dest='verify', action='store_false',
+                        help='with --quantize, save the quantized model without checking that it predicts '
+                             'the same languages as the full model on LangId.test')
+    args = parser.parse_args()
+    if not args.verify and not args.quantize:
+        parser.error('--no-verify needs --quantize')
+    #train the model on all the training corpora and save it for the three language models
+    train_files = discover_train_files()
+    model = train_model(train_files)
+    saved = quantize_model(model, args.quantize) if args.quantize else model
+    #unless --no-verify is given, a quantized model is only saved once verified: the
+    #scripts would load it silently
+    if args.quantize and args.verify:
+        results = verify_quantization(model, saved, read_files('LangId.test'))
+        for name, result in results.items():
+            print('{} model: {} predictions changed, score drift max {:.2e}, mean {:.2e}'.format(
+                name, result['changed'], result['max_drift'], result['mean_drift']))
+        if any(result['changed'] for result in results.values()):
+            sys.exit('The {} model changes predictions and was not saved: use a wider type'.format(
+                args.quantize))
+    save_model(saved, MODEL_FILE, train_files)
+    print('Saved model for {} to {} ({} bytes)'.format(
+        ', '.join(model['languages']), MODEL_FILE, os.path.getsize(MODEL_FILE)))
+    #write the profile to the standard error if profiling is on (see profiler)
+    if profiling_enabled():
+        dump_profile()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+#opt-in instrumentation of the language models
+#the stages of the models (reading, cleaning, counting, scoring) are timed and the
+#scorers count the bigrams they look up, per language, and how many of them were
+#never seen in training
+#profiling is off by default: it is turned on by enable_profiling() or by setting the
+#LANGID_PROFILE environment variable, eg LANGID_PROFILE=1 python wordLangId.py
+#when it is off, an instrumented function costs one extra call and one dict lookup
+
+PROFILE_ENV = 'LANGID_PROFILE'
+#state of the profiler; it is a dict so that modules that import it see its updates
+PROFILE = {'enabled': bool(os.environ.get(PROFILE_ENV)),
+           'stages': {},
+           'counters': Counter()}
+LOCK = threading.Lock()
+
+
+def enable_profiling(enabled=True):
+    PROFILE['enabled'] = enabled
+
+
+def profiling_enabled():
+    return PROFILE['enabled']
+
+
+def reset_profile():
+    with LOCK:
+        PROFILE['stages'] = {}
+        PROFILE['counters'] = Counter()
+
+
+def take_profile():
+    #returns the stages and counters collected so far and resets them
+    #a worker process sends them to the main process, which adds them to its own
+    #with merge_profile (the profile of a process is otherwise lost when it exits)
+    with LOCK:
+        profile = {'stages': PROFILE['stages'], 'counters': PROFILE['counters']}
+        PROFILE['stages'] = {}
+        PROFILE['counters'] = Counter()
+    return profile
+
+
+def merge_profile(profile):
+    #adds the stages and counters of another process (see take_profile)
+    #times of the stages are summed over the processes, like the calls
+    with LOCK:
+        for name, (calls, seconds) in profile['stages'].items():
+            stage = PROFILE['stages'].setdefault(name, [0, 0.0])
+            stage[0] += calls
+            stage[1] += seconds
+        PROFILE['counters'].update(profile['counters'])
+
+
+def record_stage(name, seconds):
+    #adds one call of a stage that took the given number of seconds
+    with LOCK:
+        stage = PROFILE['stages'].setdefault(name, [0, 0.0])
+        stage[0] += 1
+        stage[1] += seconds
+
+
+def profiled(name):
+    #decorator that times every call of a function as the stage name
+    #times are inclusive: the time of read_files includes the time of text_preprocess
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILE['enabled']:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                record_stage(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def count(name, value=1):
+    #adds value to a counter; counters are named 'scorer.counter' or 'scorer.counter.language'
+    if PROFILE['enabled']:
+        with LOCK:
+            PROFILE['counters'][name] += int(value)
+
+
+def count_dict_lookups(name, bigram_keys, unigram_keys, bigram_dict, unigram_dict):
+    #counts the lookups of a scorer that uses the dicts of a single language
+    #unknowns are the keys that are missing from the dicts
+    count(name + '.lookups', len(bigram_keys))
+    count(name + '.unknown_bigrams', sum(key not in bigram_dict for key in bigram_keys))
+    count(name + '.unknown_unigrams', sum(key not in unigram_dict for key in unigram_keys))
+
+
+def count_model_lookups(name, languages, unknown_bigrams, unknown_unigrams):
+    #counts the lookups of a scorer that scores all the languages of a model at once
+    #unknown_bigrams and unknown_unigrams are boolean arrays with one row per bigram
+    #and one column per language
+    count(name + '.tokens', len(unknown_bigrams))
+    for language, bigrams, unigrams in zip(languages, unknown_bigrams.sum(axis=0),
+                                           unknown_unigrams.sum(axis=0)):
+        count(name + '.lookups.' + language, len(unknown_bigrams))
+        count(name + '.unknown_bigrams.' + language, bigrams)
+        count(name + '.unknown_unigrams.' + language, unigrams)
+
+
+def profile_report():
+    #returns the collected measures as a dict
+    #stages have the number of calls and the total and mean time of the calls
+    #rates are the fraction of the lookups of each counter of unknowns
+    with LOCK:
+        stages = {name: {'calls': calls, 'seconds': seconds, 'mean_ms': seconds / calls * 1000}
+                  for name, (calls, seconds) in sorted(PROFILE['stages'].items())}
+        counters = dict(sorted(PROFILE['counters'].items()))
+    rates = {}
+    for name, value in counters.items():
+        for unknown in ['.unknown_bigrams', '.unknown_unigrams']:
+            lookups = counters.get(name.replace(unknown, '.lookups'))
+            if unknown in name and lookups:
+                rates[name] = value / lookups
+    return {'stages': stages, 'counters': counters, 'rates': rates}
+
+
+def dump_profile(stream=None):
+    #writes the report as json, by default to the standard error
+    json.dump(profile_report(), stream or sys.stderr, indent=2)
+    (stream or sys.stderr).write('\n')
@@ -0,0 +1,149 @@
+import numpy as np
+import sys
+from collections import OrderedDict
+
+#caches for repeated inputs
+#ScoreCache keeps the scores of whole sentences, keyed on the clean text of the sentence
+#(the output of normalize_lines), so that a sentence seen before is not scored again
+#BigramMemo keeps the log-probabilities of single bigrams for the original dict-based
+#scorers (score_letters, score_words and score_words_gt), which otherwise smooth and
+#take the log of every bigram of every sentence
+#a cache is only valid for the model (or dicts) it was filled with: it must be cleared
+#when the model changes, eg after modelStore.update_model
+
+#default memory bound of a ScoreCache (in bytes) and of a BigramMemo (in entries)
+CACHE_BYTES = 64 << 20
+MEMO_ENTRIES = 1 << 20
+#estimated memory used by a cache entry on top of its key and value: the dict slot,
+#the linked list node of the OrderedDict and the bookkeeping list
+ENTRY_OVERHEAD = 200
+
+
+class ScoreCache:
+    #bounded cache of the scores of sentences against all the languages of a model
+    #policy is 'lru' (least recently used entries are evicted first) or 'lfu' (least
+    #frequently used entries are evicted first; ties go to the least recently used)
+    #max_bytes bounds the estimated memory of keys, values and bookkeeping
+    def __init__(self, max_bytes=CACHE_BYTES, policy='lru'):
+        if policy not in ['lru', 'lfu']:
+            raise ValueError('unknown cache policy: {}'.format(policy))
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.clear()
+
+    def clear(self):
+        #entries map each key to [value, size, frequency]
+        self.entries = {}
+        #lru: a single list of keys, from the least to the most recently used
+        #lfu: one such list per frequency
+        self.buckets = {}
+        self.min_frequency = 1
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        #returns the cached value of key, or None
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touch(key, entry)
+        return entry[0]
+
+    def touch(self, key, entry):
+        #moves a key to the end of its list, or to the list of the next frequency
+        if self.policy == 'lru':
+            self.buckets[1].move_to_end(key)
+            return
+        bucket = self.buckets[entry[2]]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[entry[2]]
+            if self.min_frequency == entry[2]:
+                self.min_frequency += 1
+        entry[2] += 1
+        self.buckets.setdefault(entry[2], OrderedDict())[key] = None
+
+    def put(self, key, value):
+        #adds a value to the cache, evicting other entries if needed
+        #a value larger than the whole cache is not stored
+        size = sys.getsizeof(key) + sys.getsizeof(value) + ENTRY_OVERHEAD
+        if key in self.entries or size > self.max_bytes:
+            return
+        while self.bytes + size > self.max_bytes:
+            self.evict()
+        self.entries[key] = [value, size, 1]
+        self.buckets.setdefault(1, OrderedDict())[key] = None
+        self.min_frequency = 1
+        self.bytes += size
+
+    def evict(self):
+        bucket = self.buckets[self.min_frequency]
+        key, _ = bucket.popitem(last=False)
+        if not bucket:
+            del self.buckets[self.min_frequency]
+            if self.buckets:
+                self.min_frequency = min(self.buckets)
+        self.bytes -= self.entries.pop(key)[1]
+        self.evictions += 1
+
+    def stats(self):
+        #returns the hit-rate statistics and the memory usage of the cache
+        lookups = self.hits + self.misses
+        return {'policy': self.policy,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0}
+
+
+def score_cached(sentence_list, model, scorer, cache):
+    #scores a list of clean sentences with a vectorized scorer (eg score_letters_model)
+    #and a ScoreCache of that scorer: only the sentences missing from the cache are
+    #scored, in a single batch in which every distinct sentence appears once
+    #returns a matrix with one row per sentence and one column per language
+    scores = np.empty((len(sentence_list), len(model['languages'])))
+    missing = {}
+    for i, sentence in enumerate(sentence_list):
+        cached = cache.get(sentence)
+        if cached is None:
+            missing.setdefault(sentence, []).append(i)
+        else:
+            scores[i] = cached
+    if missing:
+        for (sentence, rows), sentence_scores in zip(missing.items(), scorer(list(missing), model)):
+            scores[rows] = sentence_scores
+            #rows are copied, so that the cache does not keep the whole batch alive
+            cache.put(sentence, sentence_scores.copy())
+    return scores
+
+
+class BigramMemo(dict):
+    #memo of the log-probabilities of the bigrams of one language for one dict-based
+    #scorer; a scorer must get one memo per language, as bigrams have a different
+    #log-probability in each language
+    #once max_entries bigrams are stored, new bigrams are scored but not stored
+    def __init__(self, max_entries=MEMO_ENTRIES):
+        super().__init__()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, key, logprob):
+        self.misses += 1
+        if len(self) < self.max_entries:
+            self[key] = logprob
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0}
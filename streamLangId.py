@@ -0,0 +1,154 @@
+from support import stream_chunks, normalize_lines, CHUNK_SIZE
+from modelStore import MODEL_FILE, SCORERS, load_model, load_or_train
+from profiler import profiled, profiling_enabled, dump_profile, take_profile, merge_profile
+from profiler import reset_profile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import argparse
+import asyncio
+import time
+#resource is not available on windows, where peak memory is not reported
+try:
+    import resource
+except ImportError:
+    resource = None
+
+#this script labels files of any size with the predicted language of each line, with
+#the same output as the make_output_* functions and write_out
+#it runs a pipeline of asyncio tasks:
+# - a reader decodes the input file chunk by chunk (see stream_chunks), in a thread
+# - every chunk is normalized and scored by a pool of workers
+# - a writer writes the labels of each chunk, in the order of the input, with one
+#   buffered write per chunk
+#the reader hands the pending chunks to the writer through a bounded queue: when the
+#writer or the workers fall behind, the reader waits, so that memory usage depends on
+#the size and number of chunks in flight and not on the size of the file
+
+#maximum number of chunks being scored or waiting to be written
+MAX_PENDING = 8
+#size of the buffer of the output file
+WRITE_BUFFER = 1 << 20
+#model and scorer of the workers
+STATE = {}
+
+
+def init_worker(model_path, decision, process=False):
+    #workers map the model file: processes share its pages (see load_model)
+    #a forked worker process starts with a copy of the profile of the main process,
+    #which is dropped so that it is not counted twice (see classify_chunk_profiled)
+    if process:
+        reset_profile()
+    STATE['model'] = load_model(model_path)
+    STATE['scorer'] = SCORERS[decision]
+
+
+@profiled('classify_chunk')
+def classify_chunk(lines):
+    #this function runs in the workers: it cleans a chunk of raw lines and returns the
+    #index of the predicted language of every clean, non-empty line
+    clean = [line for line in normalize_lines(lines) if line]
+    if not clean:
+        return np.zeros(0, dtype=np.int16)
+    return np.argmax(STATE['scorer'](clean, STATE['model']), axis=1).astype(np.int16)
+
+
+def classify_chunk_profiled(lines):
+    #classify_chunk for the worker processes: returns the labels with the profile taken
+    #in the worker since its previous chunk, which the writer adds to the profile of the
+    #main process (see profiler.merge_profile)
+    return classify_chunk(lines), take_profile() if profiling_enabled() else None
+
+
+async def classify_file(input_path, output_path, model_path=MODEL_FILE, decision='word', workers=1,
+                        chunk_size=CHUNK_SIZE, max_pending=MAX_PENDING):
+    #labels the lines of input_path and writes one 'line_number language' line per clean,
+    #non-empty line to output_path; the model must be saved in model_path
+    #with workers=1, chunks are scored by a single thread of this process, otherwise by
+    #a pool of workers processes, whose profiles are added to that of this process
+    #returns the number of lines written
+    loop = asyncio.get_running_loop()
+    languages = load_model(model_path)['languages']
+    pending = asyncio.Queue(max_pending)
+    if workers == 1:
+        executor = ThreadPoolExecutor(1, initializer=init_worker, initargs=(model_path, decision))
+    else:
+        executor = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(model_path, decision, True))
+    classify = classify_chunk if workers == 1 else classify_chunk_profiled
+    chunks = stream_chunks(input_path, chunk_size)
+
+    async def read():
+        #decoding runs in the default thread pool, so that the writer keeps going meanwhile
+        try:
+            while True:
+                lines = await loop.run_in_executor(None, next, chunks, None)
+                if lines is None:
+                    break
+                await pending.put(loop.run_in_executor(executor, classify, lines))
+        except Exception:
+            await pending.put(None)
+            raise
+        await pending.put(None)
+
+    async def write():
+        written = 0
+        with open(output_path, 'w', buffering=WRITE_BUFFER) as file:
+            while True:
+                future = await pending.get()
+                if future is None:
+                    return written
+                predicted = await future
+                if workers > 1:
+                    predicted, profile = predicted
+                    if profile is not None:
+                        merge_profile(profile)
+                file.write(''.join('{} {}\n'.format(written + i + 1, languages[k])
+                                   for i, k in enumerate(predicted.tolist())))
+                written += len(predicted)
+
+    with executor:
+        reader = asyncio.create_task(read())
+        try:
+            written = await write()
+            await reader
+        finally:
+            reader.cancel()
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Labels every line of a file with its language')
+    parser.add_argument('input', help='file to label')
+    parser.add_argument('output', help='file where the labels are written')
+    parser.add_argument('--model', help='path of a trained model (default: train or load the model of the '
+                                        'corpora of the working directory, see load_or_train)')
+    parser.add_argument('--decision', default='word', choices=list(SCORERS),
+                        help='language model that gives the predicted language')
+    parser.add_argument('--workers', type=int, default=1, help='number of worker processes')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='size of the chunks in bytes')
+    parser.add_argument('--max-pending', type=int, default=MAX_PENDING,
+                        help='maximum number of chunks in flight')
+    args = parser.parse_args()
+    #an explicit model is used as it is; otherwise the model of the corpora of the working
+    #directory is trained and saved if needed, so that the workers can map it
+    model_path = args.model
+    if model_path is None:
+        load_or_train(MODEL_FILE)
+        model_path = MODEL_FILE
+    start = time.perf_counter()
+    lines = asyncio.run(classify_file(args.input, args.output, model_path, args.decision, args.workers,
+                                      args.chunk_size, args.max_pending))
+    seconds = time.perf_counter() - start
+    report = 'Labelled {} lines in {:.2f}s ({:.0f} lines/sec)'.format(lines, seconds, lines / seconds)
+    if resource is not None:
+        #peak resident memory of this process and of the largest worker (in KB on linux)
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+        report += ', peak memory {:.0f} MB'.format(peak / 1e3)
+    print(report)
+    #write the profile to the standard error if profiling is on (see profiler)
+    if profiling_enabled():
+        dump_profile()
+
+
+if __name__ == "__main__":
+    main()
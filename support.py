@@ -1,21 +1,114 @@
 import re
+import mmap
+import os
+import sys
 import string
-import operator
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from profiler import profiled, count
 
+#number of words encoded at a time by the early-exit scorers
+EARLY_EXIT_BLOCK = 8
+#size of the chunks in which training and test files are read
+CHUNK_SIZE = 1 << 20
+#number of lines normalized at a time by normalize_lines
+NORMALIZE_BATCH = 1 << 14
+
+
+@profiled('read_files')
 def read_files(path):
     #function to read the training files and test file
-    #the chosen encoding has proven to be optimal given the input data
-    with open(path, 'rb',) as file:
-        data = file.read().decode('utf8', 'surrogateescape')
-        data = data.splitlines()
+    #returns the list of all the clean, non-empty lines of the file (see stream_lines)
+    lines = list(stream_lines(path))
+    count('read_files.lines', len(lines))
+    return lines
+
+
+def map_file(path):
+    #maps a file in memory, read-only: this takes constant time whatever the size of the
+    #file, and its pages are only read from disk (or shared with the page cache) when
+    #they are accessed; an empty file cannot be mapped and gives an empty bytes object
+    with open(path, 'rb') as file:
+        if not os.fstat(file.fileno()).st_size:
+            return b''
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def chunk_ranges(data, start, end, chunk_size):
+    #splits the byte range [start, end) of data in ranges of about chunk_size bytes
+    #every range but the last ends right after a newline; a line longer than chunk_size
+    #gets a longer range
+    while start < end:
+        stop = end
+        if start + chunk_size < end:
+            newline = data.rfind(b'\n', start, start + chunk_size)
+            if newline < 0:
+                newline = data.find(b'\n', start + chunk_size, end)
+            if newline >= 0:
+                stop = newline + 1
+        yield start, stop
+        start = stop
+
+
+def stream_lines(path, chunk_size=CHUNK_SIZE, start=0, end=None):
+    #generator that yields the clean, non-empty lines of a file one at a time
+    #the file is read in chunks of about chunk_size bytes (see stream_chunks), so that
+    #opening the file takes constant time and memory usage does not depend on its size
+    #start and end restrict reading to a byte range of the file (see shard_ranges)
+    for lines in stream_chunks(path, chunk_size, start, end):
         #text_preprocess() removes punctuation, makes text all lowercase and
         #removes double/leading/trailing spaces
-        data = text_preprocess(data)
-    #make sure we drop empty lines
-    data = list(filter(None, data))
-    return data
+        #make sure we drop empty lines
+        yield from filter(None, normalize_lines(lines))
 
 
+def stream_chunks(path, chunk_size=CHUNK_SIZE, start=0, end=None):
+    #generator that yields the raw lines of a file, one list of lines per chunk
+    #the file is memory mapped (see map_file) and decoded in chunks of about chunk_size
+    #bytes straight from the mapped pages
+    #chunks end at a newline (see chunk_ranges), and a newline byte never appears inside
+    #a multi-byte utf8 character: output is identical to decoding the whole file
+    #the chosen encoding has proven to be optimal given the input data
+    #where the platform supports it (not on windows), the pages of the chunks already
+    #decoded are given back (MADV_DONTNEED): they stay in the page cache but no longer
+    #count in the resident memory of the process
+    data = map_file(path)
+    view = memoryview(data)
+    released = start - start % mmap.PAGESIZE
+    try:
+        for chunk_start, chunk_end in chunk_ranges(data, start, len(data) if end is None else end, chunk_size):
+            yield str(view[chunk_start:chunk_end], 'utf8', 'surrogateescape').splitlines()
+            stop = chunk_end - chunk_end % mmap.PAGESIZE
+            if stop > released and hasattr(mmap, 'MADV_DONTNEED'):
+                data.madvise(mmap.MADV_DONTNEED, released, stop - released)
+                released = stop
+    finally:
+        #the map can only be closed once no view of it is left
+        view.release()
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def shard_ranges(path, shard_size):
+    #splits a file in byte ranges of about shard_size bytes that can be read independently
+    #every range ends right after a newline, so that no line is split across two ranges
+    #(a newline byte never appears inside a multi-byte utf8 character)
+    data = map_file(path)
+    boundaries = [0]
+    while boundaries[-1] + shard_size < len(data):
+        #move forward to the end of the current line
+        newline = data.find(b'\n', boundaries[-1] + shard_size)
+        if newline < 0:
+            break
+        boundaries.append(newline + 1)
+    if boundaries[-1] < len(data):
+        boundaries.append(len(data))
+    if isinstance(data, mmap.mmap):
+        data.close()
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+@profiled('text_preprocess')
 def text_preprocess(text_list):
     #input is a list of strings
     #output will be a list of clean strings
@@ -33,6 +126,82 @@ def text_preprocess(text_list):
     return output
 
 
+#classes of characters for normalize_lines: other, whitespace, punctuation, newline
+#the table has one entry per code point and is built on first use
+OTHER, SPACE, PUNCTUATION, NEWLINE = range(4)
+CHARACTER_CLASSES = []
+#every whitespace code point (U+3000, ideographic space, is the last one) is below
+#SPACE_LIMIT, hence only those code points need to be tested with str.isspace()
+SPACE_LIMIT = 0x3001
+
+
+def character_classes():
+    #returns the table with the class of every code point
+    #str.isspace() and str.split() agree on what a whitespace is
+    if not CHARACTER_CLASSES:
+        classes = np.zeros(sys.maxunicode + 1, dtype=np.uint8)
+        classes[[code for code in range(SPACE_LIMIT) if chr(code).isspace()]] = SPACE
+        classes[[ord(mark) for mark in string.punctuation]] = PUNCTUATION
+        classes[ord('\n')] = NEWLINE
+        CHARACTER_CLASSES.append(classes)
+    return CHARACTER_CLASSES[0]
+
+
+@profiled('normalize_lines')
+def normalize_lines(text_list, workers=1, batch_size=NORMALIZE_BATCH):
+    #bulk version of text_preprocess with an identical output (see normalize_batch)
+    #lines are normalized batch_size at a time, so that memory usage does not depend
+    #on the number of lines
+    #with workers other than 1, batches are normalized by a pool of processes (all
+    #cores with workers=None), which pays off on large inputs only
+    batches = [text_list[i:i + batch_size] for i in range(0, len(text_list), batch_size)]
+    if workers != 1 and len(batches) > 1:
+        with ProcessPoolExecutor(workers) as pool:
+            return [line for batch in pool.map(normalize_batch, batches) for line in batch]
+    return [line for batch in batches for line in normalize_batch(batch)]
+
+
+def normalize_batch(text_list):
+    #this function cleans a list of lines exactly as text_preprocess does
+    #lines are joined in a single string, whose code points are cleaned by a few
+    #vectorized passes instead of a python loop over lines:
+    # - punctuation is removed
+    # - a run of whitespaces becomes a single space, unless it is at the beginning
+    #   or at the end of a line, where it is removed
+    #lowercasing the whole text is the same as lowercasing each line, as the newline
+    #between two lines is neither a letter nor ignored by the rules of str.lower()
+    #(punctuation is removed before lowercasing, as text_preprocess does)
+    if not text_list:
+        return []
+    text = '\n'.join(text_list)
+    #a line that contains a newline cannot be told apart from two lines
+    if text.count('\n') != len(text_list) - 1:
+        return text_preprocess(text_list)
+    #the code points are read through a numpy string, which is much faster than
+    #encoding text with lone surrogates (see read_files) to utf-32
+    #a final newline keeps numpy from dropping trailing null characters
+    codes = np.array([text + '\n']).view(np.uint32)
+    classes = np.take(character_classes(), codes)
+    is_text = classes != PUNCTUATION
+    codes = codes[is_text]
+    classes = classes[is_text]
+    #a run of whitespaces is kept (as a single space) if the characters before and
+    #after the run belong to words; thanks to the final newline, every run ends before
+    #the end of the text, and a run at the very beginning of the text looks back at
+    #that newline (index -1), hence it is dropped
+    space = classes == SPACE
+    padded = np.concatenate(([False], space))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    starts, ends = edges[0::2], edges[1::2]
+    kept = starts[(classes[starts - 1] == OTHER) & (classes[ends] == OTHER)]
+    keep = ~space
+    keep[kept] = True
+    codes[kept] = ord(' ')
+    codes = codes[keep]
+    text = str(codes.view('<U{}'.format(len(codes)))[0])
+    return text.lower().split('\n')[:-1]
+
+
 def write_out(output_file, output_list):
     #write the final output in the output file
     with open(output_file, 'w') as file:
@@ -40,6 +209,14 @@ def write_out(output_file, output_list):
             file.write(x + '\n')
 
 
+def read_solution(path):
+    #read ground truth, ie the solution: one 'line_number language' string per line
+    with open(path, 'r') as file:
+        sol = file.readlines()
+        sol = [x.replace('\n', '') for x in sol]
+    return sol
+
+
 def compute_performance(output_list, ground_truth):
     #function to check percentage accuracy of a specific language model
     #compares output list from a language model with ground truth
@@ -50,3 +227,104 @@ def compute_performance(output_list, ground_truth):
         if output_list[i] == ground_truth[i]:
             count += 1
     return round(count/N*100, 1)
+
+
+#the vectorized models intern letters and words to integer ids
+#ids 0, 1 and 2 are reserved for the special characters <b> and <e> and for
+#tokens that were never seen in training; the vocabulary starts at id 3
+BEGIN_ID = 0
+END_ID = 1
+UNKNOWN_ID = 2
+FIRST_ID = 3
+
+
+def sentence_starts(sizes):
+    #returns the position of the first value of each sentence (see sum_by_sentence)
+    #given the number of values (eg of bigrams) of each sentence
+    starts = np.zeros(len(sizes), dtype=np.int64)
+    np.cumsum(sizes[:-1], out=starts[1:])
+    return starts
+
+
+def merge_key_counts(tables):
+    #merges tables of sorted keys (eg of bigrams or of n-gram hashes) and of the count
+    #of each key into a single table, whose counts are the sums of the counts of each key
+    if not tables:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if len(tables) == 1:
+        return tables[0]
+    keys, inverse = np.unique(np.concatenate([keys for keys, counts in tables]), return_inverse=True)
+    #the weighted sum is computed in floats, which are exact for any realistic count
+    weights = np.concatenate([counts for keys, counts in tables])
+    return keys, np.bincount(inverse, weights, len(keys)).astype(np.int64)
+
+
+def sum_by_sentence(values, starts):
+    #sums the values (eg the log-probabilities of the bigrams) of each sentence
+    #values of sentence i begin at position starts[i]
+    #values can be a 1D array or a 2D array with one row per bigram
+    #np.add.reduceat does not handle empty sentences, hence those are skipped
+    #and keep a sum of 0
+    #values of quantized models (see modelStore.quantize_model) are summed in float64 or
+    #int64, so that float32 values do not lose precision and int16 values do not overflow
+    sums = np.zeros((len(starts),) + values.shape[1:])
+    ends = np.append(starts[1:], len(values))
+    nonempty = starts != ends
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(values, starts[nonempty],
+                                         dtype=sums.dtype if values.dtype.kind == 'f' else np.int64)
+    return sums
+
+
+def early_exit_scores(blocks, margin, num_languages, num_bigrams, rate):
+    #this function accumulates the log-probabilities of the bigrams of a sentence and
+    #stops as soon as the leading language is ahead of the second one by a bound that
+    #the remaining bigrams cannot overturn: margin plus rate times the number of bigrams
+    #left (num_bigrams is the number of bigrams of the whole sentence)
+    #with rate the largest gap between the log-probabilities of two languages for a
+    #single bigram (see max_log_ratio), no remaining bigram can change the prediction and
+    #the result is that of full scoring; a smaller rate exits earlier but is a heuristic,
+    #and with rate 0 the bound is the fixed margin whatever the length of the sentence
+    #blocks yields arrays with one row per bigram and one column per language, in the
+    #order in which bigrams appear in the sentence: bigrams of the following blocks
+    #are never encoded nor looked up once the sentence is decided
+    #returns the scores of all languages and the number of bigrams that were scored
+    total = np.zeros(num_languages)
+    consumed = 0
+    for block in blocks:
+        cumulative = total + np.cumsum(block, axis=0)
+        if num_languages > 1:
+            #gap between the two highest scores after each bigram of the block
+            top_two = np.partition(cumulative, -2, axis=1)[:, -2:]
+            remaining = num_bigrams - consumed - np.arange(1, len(block) + 1)
+            decided = np.flatnonzero(top_two[:, 1] - top_two[:, 0] >= margin + rate * remaining)
+            if len(decided):
+                return cumulative[decided[0]], consumed + int(decided[0]) + 1
+        total = cumulative[-1]
+        consumed += len(block)
+    return total, consumed
+
+
+def max_log_ratio(*tables, scale=1):
+    #returns the largest gap between the log-probabilities of two languages in any row of
+    #the tables (one column per language), ie the most a single bigram can change the
+    #gap between the scores of two languages (see early_exit_scores)
+    #int16 tables are divided by their scale (see modelStore.quantize_model)
+    return max(float((table.max(axis=-1) - table.min(axis=-1)).max(initial=0)) for table in tables) / scale
+
+
+def predict_languages(scores, languages):
+    #this function takes a matrix of scores with one row per sentence and one column
+    #per language and returns the predicted language of each sentence
+    #the predicted language is the language that is associated to the highest proba
+    #np.argmax returns the first language in case of ties, just like max() does
+    return [languages[k] for k in np.argmax(scores, axis=1)]
+
+
+def make_output(scores, languages):
+    #this function takes a matrix of scores with one row per sentence and one column
+    #per language and returns a list with the predicted language for each sentence
+    output = []
+    for i, predicted_language in enumerate(predict_languages(scores, languages)):
+        output.append('{} {}'.format(i+1, predicted_language))
+    return output
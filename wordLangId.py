@@ -1,6 +1,13 @@
-from support import read_files, text_preprocess, write_out, compute_performance
+from support import read_files, read_solution, text_preprocess, write_out, compute_performance
+from support import BEGIN_ID, END_ID, UNKNOWN_ID, FIRST_ID, sum_by_sentence, sentence_starts, make_output
+from support import merge_key_counts
+from support import EARLY_EXIT_BLOCK, early_exit_scores, max_log_ratio, stream_lines
+from profiler import profiled, profiling_enabled, count_dict_lookups, count_model_lookups, dump_profile
+from scoreCache import score_cached
 import numpy as np
-import operator
+import hashlib
+import argparse
+from collections import Counter
 
 
 def make_word_key(words, i):
@@ -18,6 +25,7 @@ def make_word_key(words, i):
     return key
 
 
+@profiled('bigram_word_dict')
 def bigram_word_dict(sentence_list):
     #function to obtain count of each word bigram in the train corpus
     #input is a list of strings
@@ -39,13 +47,17 @@ def bigram_word_dict(sentence_list):
     return word_bigrams_dict
 
 
+@profiled('unigram_word_dict')
 def unigram_word_dict(sentence_list):
     #function to obtain count of each word unigram in the train corpus
     #input is a list of strings
     #for each sentence in that list, we need to turn it in a list of words
     #then, we traverse the list of words and create word unigrams
+    #sentence_list can be any iterable of lines, eg the stream_lines generator
     word_unigrams_dict = {}
+    sentences = 0
     for line in sentence_list:
+        sentences += 1
         for word in line.split():
             if word in word_unigrams_dict:
                 word_unigrams_dict[word]+=1
@@ -53,18 +65,21 @@ def unigram_word_dict(sentence_list):
                 word_unigrams_dict[word] = 1
     #total number of sentences gives us the number of times we saw the special chars
     #'beginning of sentence' and 'end of sentence'
-    word_unigrams_dict['<b>'] = len(sentence_list)
-    word_unigrams_dict['<e>'] = len(sentence_list)
+    word_unigrams_dict['<b>'] = sentences
+    word_unigrams_dict['<e>'] = sentences
     return word_unigrams_dict
 
 
-def score_words(sentence, uniword, biword):
+@profiled('score_words')
+def score_words(sentence, uniword, biword, memo=None):
     #this is the function that performs the language model scoring for word bigrams
     #it takes a sentence, a python dict with count of unigrams in train
     #and a python dict with count of bigrams in train and returns the add-one smoothed
     #probability that the provided sentence is in the language of the two dictionaries
     #note that smoothing is done on the fly for counts and smoothed counts are
     #then turned into probabilities on the fly using MLE
+    #memo is an optional scoreCache.BigramMemo of the language of the two dictionaries:
+    #bigrams found in the memo are not smoothed again
 
     #V is the size of the vocabulary, ie the count of distinct unigrams
     V = len(uniword)
@@ -76,6 +91,10 @@ def score_words(sentence, uniword, biword):
     words = sentence.split()
     for i in range(0, len(words)+1):
         bigram_key = make_word_key(words, i)
+        if memo is not None and bigram_key in memo:
+            memo.hits += 1
+            score += memo[bigram_key]
+            continue
         unigram_key = bigram_key.split(' ')[0]
         
         #here we perform the add-one smoothing of the counts
@@ -97,55 +116,433 @@ def score_words(sentence, uniword, biword):
         
         #turn counts into conditional probability using MLE 
         proba = np.log(numerator/denominator)
+        if memo is not None:
+            memo.add(bigram_key, proba)
         score += proba
+    if profiling_enabled():
+        keys = [make_word_key(words, i) for i in range(0, len(words)+1)]
+        count_dict_lookups('score_words', keys, [key.split(' ')[0] for key in keys], biword, uniword)
     return score
 
 
-def make_output_words(test,
-                       uniword_dict_eng, biword_dict_eng,
-                       uniword_dict_ita, biword_dict_ita,
-                       uniword_dict_fra, biword_dict_fra):
-    #this function takes the test sentences and a series of unigram/bigram counts
-    #and returns a list with the predicted language for each sentence in the test set
-    #for each sentence, model is scored using the ENG, ITA and FRA dictionaries
+#the functions below implement an alternative way of counting word bigrams
+#a dict with one key per distinct bigram grows with the size of the corpus; a
+#count-min sketch stores the counts in a fixed number of cells instead
+#the sketch has depth rows of width cells: each bigram is hashed to one cell per row,
+#adding a bigram increments all its cells and its count is the minimum of its cells
+#collisions can only make a count larger than the true count, never smaller
+SKETCH_WIDTH = 1 << 16
+SKETCH_DEPTH = 4
+#number of sentences hashed and added to a sketch at a time
+SKETCH_BATCH = 1024
+
+
+def word_hashes(words):
+    #returns a 64 bit hash of each word
+    #python's hash() of a string changes from one process to the other, hence it cannot
+    #be used for a sketch that is built once and used in other processes
+    return np.array([int.from_bytes(hashlib.blake2b(word.encode('utf8', 'surrogateescape'),
+                                                    digest_size=8).digest(), 'little')
+                     for word in words], dtype=np.uint64)
+
+
+def sentence_bigram_hashes(sentence_list):
+    #returns the hash of every word bigram of a list of sentences, the first word of
+    #each bigram and, for each sentence, the position of its first bigram
+    #words are hashed only once per call
+    first_words = []
+    second_words = []
+    sizes = []
+    for line in sentence_list:
+        padded = ['<b>'] + line.split() + ['<e>']
+        first_words.extend(padded[:-1])
+        second_words.extend(padded[1:])
+        sizes.append(len(padded) - 1)
+    distinct = {word: i for i, word in enumerate(set(first_words).union(second_words))}
+    hashes = word_hashes(distinct)
+    first = hashes[[distinct[word] for word in first_words]]
+    second = hashes[[distinct[word] for word in second_words]]
+    starts = sentence_starts(sizes)
+    #the two hashes are combined so that 'a b' and 'b a' are different bigrams
+    return first * np.uint64(0x9E3779B97F4A7C15) ^ second, first_words, starts
+
+
+def make_sketch(width=SKETCH_WIDTH, depth=SKETCH_DEPTH, seed=0):
+    #returns an empty count-min sketch
+    #besides the table of counts, the sketch keeps the total number of bigrams and an
+    #estimate of their frequencies of frequencies, which are needed by GT smoothing
+    rng = np.random.default_rng(seed)
+    return {'table': np.zeros((depth, width), dtype=np.uint32),
+            'multipliers': rng.integers(0, np.iinfo(np.uint64).max, size=depth, dtype=np.uint64) | np.uint64(1),
+            'total': 0,
+            'Nx': Counter()}
+
+
+def sketch_cells(sketch, hashes):
+    #returns the cell of each bigram hash in each row of the sketch
+    #every row mixes the hash with its own odd multiplier (multiplications wrap around)
+    mixed = hashes[None, :] * sketch['multipliers'][:, None]
+    mixed ^= mixed >> np.uint64(29)
+    return (mixed % np.uint64(sketch['table'].shape[1])).astype(np.int64)
+
+
+def sketch_query(sketch, hashes):
+    #returns the estimated count of each bigram hash
+    cells = sketch_cells(sketch, hashes)
+    rows = np.arange(len(cells))[:, None]
+    return sketch['table'][rows, cells].min(axis=0).astype(np.int64)
+
+
+def sketch_add(sketch, hashes):
+    #adds one occurrence of each bigram hash to the sketch
+    #the frequencies of frequencies are updated with the counts before and after the update:
+    #a bigram whose count goes from x to y moves from N(x) to N(y)
+    distinct, occurrences = np.unique(hashes, return_counts=True)
+    before = sketch_query(sketch, distinct)
+    cells = sketch_cells(sketch, distinct)
+    rows = np.arange(len(cells))[:, None]
+    np.add.at(sketch['table'], (rows, cells), occurrences.astype(np.uint32)[None, :])
+    after = sketch_query(sketch, distinct)
+    sketch['Nx'].subtract(Counter(before[before > 0].tolist()))
+    sketch['Nx'].update(Counter(after.tolist()))
+    sketch['total'] += len(hashes)
+
+
+def bigram_word_sketch(sentence_list, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+    #alternative to bigram_word_dict that counts the word bigrams of the train corpus
+    #in a count-min sketch: memory usage is fixed by width and depth
+    #sentences are hashed and added SKETCH_BATCH at a time, so that sentence_list can be
+    #any iterable (eg the stream_lines generator)
+    sketch = make_sketch(width, depth)
+    batch = []
+    for line in sentence_list:
+        batch.append(line)
+        if len(batch) == SKETCH_BATCH:
+            sketch_add(sketch, sentence_bigram_hashes(batch)[0])
+            batch = []
+    if batch:
+        sketch_add(sketch, sentence_bigram_hashes(batch)[0])
+    #bigrams that collided into larger counts leave entries of 0 behind
+    sketch['Nx'] = +sketch['Nx']
+    return sketch
+
+
+def score_words_sketch(sentence_list, uniword, sketch):
+    #vectorized version of score_words that reads the bigram counts from a count-min sketch
+    #it takes a list of sentences, the dict with the count of unigrams in train and the
+    #sketch with the count of bigrams and returns an array with the score of each sentence
+    V = len(uniword)
+    hashes, first_words, starts = sentence_bigram_hashes(sentence_list)
+    numerator = sketch_query(sketch, hashes) + 1
+    denominator = np.array([uniword.get(word, 0) for word in first_words]) + V
+    return sum_by_sentence(np.log(numerator / denominator), starts)
+
+
+#the sketch backend of the word models is a dict with:
+# - 'languages': the list of languages
+# - 'uniword': the dict with the count of unigrams of each language
+# - 'sketches': the count-min sketch with the count of bigrams of each language
+#it is trained from the corpora and kept in memory only (it is not saved by modelStore)
+def train_word_sketches(train_files, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+    #trains the sketch backend of the word models of the languages of train_files
+    #(language -> path of its corpus, see modelStore.discover_train_files)
+    #each corpus is streamed twice, so that the lines are never all held in memory
+    return {'languages': list(train_files),
+            'uniword': [unigram_word_dict(stream_lines(path)) for path in train_files.values()],
+            'sketches': [bigram_word_sketch(stream_lines(path), width, depth) for path in train_files.values()]}
+
+
+def score_words_sketch_model(sentence_list, sketch_model):
+    #counterpart of score_words_model for the sketch backend: returns a (sentences, languages)
+    #array of add-one scores
+    return np.column_stack([score_words_sketch(sentence_list, uniword, sketch)
+                            for uniword, sketch in zip(sketch_model['uniword'], sketch_model['sketches'])])
+
+
+#the functions below implement a vectorized version of the word bigram model
+#words are interned to integer ids (see support.py for the reserved ids) and the
+#counts are kept in a compact two-level store instead of dicts keyed by 'w1 w2' strings:
+#for each word (the predecessor), the store holds the sorted ids of the words seen
+#after it (its successors) and, in a parallel array, the count of each of those bigrams
+#a store is a dict with:
+# - 'words': the words, from id FIRST_ID on (<b> and <e> have their own ids)
+# - 'unigram_counts': the count of each word, indexed by id
+# - 'offsets': the successors of word i are successors[offsets[i]:offsets[i + 1]]
+# - 'successors': the ids of the successors (int32)
+# - 'counts': the count of each bigram, in the order of the successors
+#bigrams are therefore sorted by first and then by second id, and a bigram is looked
+#up by a binary search among the successors of its first word (see lookup_bigrams)
+#in a trained model (see modelStore) the ids are shared by all languages and the
+#counts have an extra last axis with one column per language
+
+#number of ids buffered by count_word_store before they are added to the counts
+PAIR_BATCH = 1 << 20
+
+
+@profiled('count_word_store')
+def count_word_store(sentence_list, pair_batch=PAIR_BATCH):
+    #function to obtain the count of each word unigram and bigram of a corpus as a store
+    #sentence_list can be any iterable of lines, eg the stream_lines generator
+    #words get ids in order of first appearance and bigrams are counted as pairs of
+    #ids, hence no string is built for each bigram: the ids of the padded lines are
+    #buffered and counted with numpy every pair_batch ids
+    #the counts are identical to those of unigram_word_dict and bigram_word_dict
+    word_ids = {'<b>': BEGIN_ID, '<e>': END_ID}
+    intern = word_ids.setdefault
+    ids = []
+    unigram_counts = np.zeros(FIRST_ID, dtype=np.int64)
+    tables = []
+    for line in sentence_list:
+        ids.append(BEGIN_ID)
+        #the ids of new words skip UNKNOWN_ID
+        ids.extend([intern(word, len(word_ids) + 1) for word in line.split()])
+        ids.append(END_ID)
+        if len(ids) >= pair_batch:
+            unigram_counts = add_word_ids(unigram_counts, tables, ids)
+            ids = []
+    unigram_counts = add_word_ids(unigram_counts, tables, ids)
+    pairs, bigram_counts = merge_key_counts(tables)
+    #words are in order of id, as dicts keep the order of insertion
+    words = [word for word, i in word_ids.items() if i >= FIRST_ID]
+    return make_word_store(words, unigram_counts, pairs >> 32, pairs & 0xffffffff, bigram_counts)
+
+
+def add_word_ids(unigram_counts, tables, ids):
+    #adds the unigrams of a list of ids (whole lines padded with <b> and <e>) to the
+    #unigram counts of count_word_store, which are returned, and pushes the table of
+    #their bigrams on the stack of tables of count_word_store
+    #a table holds the sorted keys of bigrams (first_id << 32 | second_id) and the count
+    #of each key; tables are merged only with a table of similar size (the previous one
+    #on the stack, as long as it is not more than twice as large), so that every key
+    #is merged a logarithmic number of times and not once per batch
+    if not ids:
+        return unigram_counts
+    ids = np.array(ids, dtype=np.int64)
+    new_counts = np.bincount(ids)
+    if len(new_counts) > len(unigram_counts):
+        unigram_counts = np.concatenate(
+            (unigram_counts, np.zeros(len(new_counts) - len(unigram_counts), dtype=np.int64)))
+    unigram_counts[:len(new_counts)] += new_counts
+    #<e> followed by <b> is the boundary between two sentences, not a bigram
+    is_bigram = ids[:-1] != END_ID
+    tables.append(np.unique((ids[:-1] << 32 | ids[1:])[is_bigram], return_counts=True))
+    while len(tables) > 1 and 2 * len(tables[-1][0]) >= len(tables[-2][0]):
+        tables[-2:] = [merge_key_counts(tables[-2:])]
+    return unigram_counts
+
+
+def make_word_store(words, unigram_counts, first, second, bigram_counts):
+    #builds a store from the ids of the bigrams, which must be sorted by first and
+    #then by second id, and from their counts
+    size = len(words) + FIRST_ID
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(first, minlength=size), out=offsets[1:])
+    return {'words': words,
+            'unigram_counts': unigram_counts,
+            'offsets': offsets,
+            'successors': second.astype(np.int32),
+            'counts': bigram_counts}
+
+
+def store_predecessors(offsets):
+    #returns the id of the first word of each bigram of a store
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def merge_word_stores(stores, columns=None):
+    #merges several stores into a single store with one column of counts per store
+    #the ids of the merged store are shared by all columns, with words in sorted order
+    #with columns, the counts of the i-th store are added to column columns[i] instead,
+    #eg to sum the stores of several shards of a corpus in a single column
+    if columns is None:
+        columns = range(len(stores))
+    num_columns = max(columns, default=0) + 1
+    words = sorted(set().union(*[store['words'] for store in stores]))
+    word_ids = dict(zip(words, range(FIRST_ID, FIRST_ID + len(words))))
+    size = len(words) + FIRST_ID
+    #ids of each store in the merged store
+    mappings = [np.array([BEGIN_ID, END_ID, UNKNOWN_ID] + [word_ids[word] for word in store['words']],
+                         dtype=np.int64)
+                for store in stores]
+    keys = [mapping[store_predecessors(store['offsets'])] * size + mapping[store['successors']]
+            for store, mapping in zip(stores, mappings)]
+    merged_keys, inverse = np.unique(np.concatenate(keys) if keys else np.zeros(0, dtype=np.int64),
+                                     return_inverse=True)
+    unigram_counts = np.zeros((size, num_columns), dtype=np.int64)
+    bigram_counts = np.zeros((len(merged_keys), num_columns), dtype=np.int64)
+    start = 0
+    for store, mapping, store_keys, column in zip(stores, mappings, keys, columns):
+        #the ids of a store are distinct, hence the sums below do not need np.add.at
+        unigram_counts[mapping, column] += store['unigram_counts']
+        bigram_counts[inverse[start:start + len(store_keys)], column] += store['counts']
+        start += len(store_keys)
+    return make_word_store(words, unigram_counts, merged_keys // size, merged_keys % size, bigram_counts)
+
+
+def addone_logprob_arrays(unigram_counts, bigram_counts, bigram_first):
+    #this function precomputes the add-one smoothed log-probabilities of score_words
+    #it takes the counts of a store and the first word of each bigram (see
+    #store_predecessors) and returns two vectors:
+    # - the log of the conditional probability of each bigram of the store
+    # - the log of the conditional probability of a bigram never seen in training,
+    #   which only depends on the first word of the bigram
+    #V is the size of the vocabulary of the language, exactly as in score_words
+    #counts can also have an extra last axis with one column per language
+    V = np.count_nonzero(unigram_counts, axis=0)
+    bigram_logprob = np.log((bigram_counts + 1) / (unigram_counts[bigram_first] + V))
+    unseen_logprob = np.log(1 / (unigram_counts + V))
+    return bigram_logprob, unseen_logprob
+
+
+@profiled('encode_words')
+def encode_words(sentence_list, word_ids):
+    #this function turns a list of sentences into the ids of all their word bigrams
+    #returns the ids of the first and second word of each bigram and, for each
+    #sentence, the position of its first bigram
+    get_id = word_ids.get
+    ids = []
+    sizes = []
+    for line in sentence_list:
+        words = line.split()
+        ids.append(BEGIN_ID)
+        ids.extend([get_id(word, UNKNOWN_ID) for word in words])
+        ids.append(END_ID)
+        sizes.append(len(words) + 1)
+    ids = np.array(ids, dtype=np.int64)
+    #<e> followed by <b> is the boundary between two sentences, not a bigram
+    is_bigram = ids[:-1] != END_ID
+    starts = sentence_starts(sizes)
+    return ids[:-1][is_bigram], ids[1:][is_bigram], starts
+
+
+def lookup_bigrams(first, second, offsets, successors):
+    #returns the position of each bigram in a store and whether it was found
+    #each bigram is searched among the successors of its first word; the binary searches
+    #of all bigrams run at once, with steps of decreasing powers of two: at each step,
+    #a search moves forward if the successor step - 1 places ahead is still too small
+    #the position of a bigram that was not found is the one where it would be inserted
+    low = offsets[first]
+    end = offsets[first + 1]
+    #largest power of two not above the number of successors of any word
+    step = 1 << int((end - low).max(initial=0)).bit_length() >> 1
+    second = second.astype(successors.dtype)
+    last = len(successors) - 1
+    while step:
+        probe = low + (step - 1)
+        forward = successors[np.minimum(probe, last)] < second
+        forward &= probe < end
+        low += forward * step
+        step >>= 1
+    found = low < end
+    found[found] = successors[low[found]] == second[found]
+    return low, found
+
+
+@profiled('score_words_model')
+def score_words_model(sentence_list, model, smoothing='addone'):
+    #scores a list of sentences against every language of a trained model (see modelStore)
+    #smoothing is either 'addone' or 'gt' (Good-Turing)
+    #the log-probabilities of all languages are stored next to each other, hence
+    #sentences are encoded once and a single gather scores them against all languages
+    #returns a matrix with one row per sentence and one column per language
+    first, second, starts = encode_words(sentence_list, model['word_ids'])
+    pos, found = lookup_bigrams(first, second, model['bigram_offsets'], model['bigram_successors'])
+    pos = np.minimum(pos, len(model['bigram_successors']) - 1)
+    if profiling_enabled():
+        #a bigram (or its first word) is unknown to a language if its count is 0
+        count_model_lookups('score_words_model.' + smoothing, model['languages'],
+                            ~found[:, None] | (model['word_bigram_counts'][pos] == 0),
+                            model['word_unigram_counts'][first] == 0)
+    logprob = np.where(found[:, None],
+                       model[smoothing + '_bigram_logprob'][pos],
+                       model[smoothing + '_unseen_logprob'][first])
+    #int16 log-probabilities are scaled integers (see modelStore.quantize_model)
+    return sum_by_sentence(logprob, starts) / model.get(smoothing + '_scale', 1)
+
+
+def score_words_early_exit(sentence, model, margin, smoothing='addone', rate=None, block_size=EARLY_EXIT_BLOCK):
+    #opt-in sequential version of score_words_model for a single, possibly long, sentence
+    #words are encoded and scored block_size at a time, and scoring stops as soon as
+    #a language leads by margin plus rate per word bigram left (see early_exit_scores)
+    #by default, rate is the largest gap of the model between two languages for one
+    #bigram, so that the prediction is that of full scoring; it is computed over the
+    #whole tables, hence a caller that scores many sentences should compute it once
+    #with early_exit_rate_words
+    #returns the scores of all languages and the number of word bigrams scored
+    words = sentence.split()
+    if rate is None:
+        rate = early_exit_rate_words(model, smoothing)
+    get_id = model['word_ids'].get
+    bigram_logprob = model[smoothing + '_bigram_logprob']
+    unseen_logprob = model[smoothing + '_unseen_logprob']
+    scale = model.get(smoothing + '_scale', 1)
+
+    def blocks():
+        #each block starts with the last word of the previous block, so that the
+        #bigram between the two blocks is scored as well
+        previous = BEGIN_ID
+        for i in range(0, len(words) + 1, block_size):
+            ids = [previous] + [get_id(word, UNKNOWN_ID) for word in words[i:i + block_size]]
+            if i + block_size > len(words):
+                ids.append(END_ID)
+            ids = np.array(ids, dtype=np.int64)
+            pos, found = lookup_bigrams(ids[:-1], ids[1:], model['bigram_offsets'], model['bigram_successors'])
+            pos = np.minimum(pos, len(model['bigram_successors']) - 1)
+            yield np.where(found[:, None], bigram_logprob[pos], unseen_logprob[ids[:-1]]) / scale
+            previous = ids[-1]
+
+    return early_exit_scores(blocks(), margin, len(model['languages']), len(words) + 1, rate)
+
+
+def early_exit_rate_words(model, smoothing='addone'):
+    #returns the largest gap between the word log-probabilities (seen or unseen bigrams)
+    #of two languages for a single bigram (see early_exit_scores)
+    return max_log_ratio(model[smoothing + '_bigram_logprob'], model[smoothing + '_unseen_logprob'],
+                         scale=model.get(smoothing + '_scale', 1))
+
+
+def make_output_words(test, model, cache=None):
+    #this function takes the test sentences and a trained model of any number of
+    #languages and returns a list with the predicted language for each sentence
     #the predicted language is the language that is associated to the highest proba
-    output = []
-    for i in range(len(test)):
-        test_line = test[i]
-        results = {'English': score_words(test_line, uniword_dict_eng, biword_dict_eng),
-                   'Italian': score_words(test_line, uniword_dict_ita, biword_dict_ita),
-                   'French' : score_words(test_line, uniword_dict_fra, biword_dict_fra)}
-        predicted_language = max(results.items(), key=operator.itemgetter(1))[0]
-        output.append('{} {}'.format(i+1, predicted_language))
-    return output
+    #with a scoreCache.ScoreCache of this model, sentences in the cache are not scored again
+    if cache is not None:
+        return make_output(score_cached(test, model, score_words_model, cache), model['languages'])
+    return make_output(score_words_model(test, model), model['languages'])
+
+
+def make_output_words_sketch(test, sketch_model):
+    #same as make_output_words with the sketch backend of the word models
+    return make_output(score_words_sketch_model(test, sketch_model), sketch_model['languages'])
+
 
 def main():
-    #read train data
-    ita = read_files('LangId.train.Italian')
-    fra = read_files('LangId.train.French')
-    eng = read_files('LangId.train.English')
+    parser = argparse.ArgumentParser(description='Word bigram model with add-one smoothing')
+    parser.add_argument('--backend', default='store', choices=['store', 'sketch'],
+                        help='store: exact bigram counts of the trained model (see modelStore); '
+                             'sketch: bigram counts in count-min sketches of fixed size')
+    parser.add_argument('--sketch-width', type=int, default=SKETCH_WIDTH)
+    parser.add_argument('--sketch-depth', type=int, default=SKETCH_DEPTH)
+    args = parser.parse_args()
+
+    #modelStore is imported here because it imports this module
+    from modelStore import load_or_train, discover_train_files
     #read test data
     test = read_files('LangId.test')
     #read ground truth, ie the solution
-    with open('LangId.sol', 'r') as file:
-        sol = file.readlines()
-        sol = [x.replace('\n', '') for x in sol]
-
-    #create word unigram counts
-    uniword_dict_ita = unigram_word_dict(ita)
-    uniword_dict_fra = unigram_word_dict(fra)
-    uniword_dict_eng = unigram_word_dict(eng)
-
-    #create word bigram counts
-    biword_dict_ita = bigram_word_dict(ita)
-    biword_dict_fra = bigram_word_dict(fra)
-    biword_dict_eng = bigram_word_dict(eng)
+    sol = read_solution('LangId.sol')
 
     #create list with predicted languages of all sentences in test data
-    output_word = make_output_words(test,
-                       uniword_dict_eng, biword_dict_eng,
-                       uniword_dict_ita, biword_dict_ita,
-                       uniword_dict_fra, biword_dict_fra)
+    if args.backend == 'sketch':
+        #the sketches are trained from the corpora at every run
+        sketch_model = train_word_sketches(discover_train_files(), args.sketch_width, args.sketch_depth)
+        output_word = make_output_words_sketch(test, sketch_model)
+    else:
+        #load the trained model of all languages (see modelStore)
+        #the model is trained from the corpora only if it was never saved or if the
+        #corpora changed since
+        model = load_or_train()
+        output_word = make_output_words(test, model)
 
     #write output to file
     write_out('wordLangId.out', output_word)
@@ -154,5 +551,9 @@ def main():
     perf = compute_performance(output_word, sol)
     print('Accuracy of word bigram model with add-one smoothing: {}%'.format(perf))
 
+    #write the profile to the standard error if profiling is on (see profiler)
+    if profiling_enabled():
+        dump_profile()
+
 if __name__ == "__main__":
     main()
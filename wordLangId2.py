@@ -1,30 +1,48 @@
-from support import read_files, text_preprocess, write_out, compute_performance
+from support import read_files, read_solution, text_preprocess, write_out, compute_performance, make_output
+from support import sum_by_sentence
 #note that some functions are identical across the two word-based models
 #hence, we import those from the other script
-from wordLangId import make_word_key, bigram_word_dict, unigram_word_dict
+from wordLangId import make_word_key, score_words_model
+from wordLangId import sentence_bigram_hashes, sketch_query, train_word_sketches, SKETCH_WIDTH, SKETCH_DEPTH
+from profiler import profiled, profiling_enabled, count_dict_lookups, dump_profile
+from scoreCache import score_cached
 import numpy as np
-import operator
+import argparse
 from collections import Counter
 
 
+@profiled('turing_smoothing_dict')
 def turing_smoothing_dict(uniword, biword):
     #this function returns a series of values that we will need to apply GT smoothing
+    #it takes the python dicts with the count of unigrams and bigrams in train
+    #see turing_smoothing_counts for the details
+    return turing_smoothing_counts(list(uniword.values()), list(biword.values()))
+
+
+def turing_smoothing_counts(unigram_counts, bigram_counts):
+    #this function returns a series of values that we will need to apply GT smoothing
+    #it takes the lists of counts of the unigrams and of the bigrams seen in train
     #first of all, it computes -for both unigrams and bigrams- the frequency of frequencies vector
     #this is a vector that, for each value x, shows how many tokens were observed x times
     #we need a vector that collects Nx's for all x's, where Nx is the number of N-grams that
     #occur x times in the training corpus
     #it will also com
-    turing_bigram_dict = {}
+    #need to get Nx for unigrams and bigrams
+    return turing_smoothing_nx(dict(Counter(unigram_counts)), dict(Counter(bigram_counts)))
+
+
+def turing_smoothing_nx(Nx_unigram, Nx_bigram):
+    #this function completes the Nx's of the unigrams and bigrams seen in train with the
+    #Nx's of the unknowns and finds the GT thresholds (see turing_smoothing_counts)
     #need to compute the total number of possible bigrams
     #this will allow us to count number of unknown bigrams
     #total number of possible bigrams is the square of the number of unigrams
     #number of unknown bigrams is given by the following formula
     #"number of total possible bigrams minus number of known bigrams"
-    total_number_bigrams = len(uniword)**2
-    count_unknowns_bigrams = total_number_bigrams - len(biword)
-    #need to get Nx for unigrams and bigrams
-    Nx_unigram = dict(Counter(uniword.values()))
-    Nx_bigram = dict(Counter(biword.values()))
+    Nx_unigram = dict(Nx_unigram)
+    Nx_bigram = dict(Nx_bigram)
+    total_number_bigrams = sum(Nx_unigram.values())**2
+    count_unknowns_bigrams = total_number_bigrams - sum(Nx_bigram.values())
     #need to account for bigrams we have never seen before
     Nx_bigram[0] = count_unknowns_bigrams
     #need to account for unigrams we have never seen before
@@ -39,20 +57,141 @@ def turing_smoothing_dict(uniword, biword):
     #given that we are applying smoothing to some (but not all tokens) probabilities
     #will not sum to one, but this is again a minor concern
     #here we find the threshold for both bigrams and unigrams
-    unigram_sorted_keys = sorted(Nx_unigram.keys())
-    for i in range(0, len(unigram_sorted_keys)):
-        if i != unigram_sorted_keys[i]:
-            unigram_threshold = unigram_sorted_keys[i-1]
-            break
-    bigram_sorted_keys = sorted(Nx_bigram.keys())
-    for i in range(0, len(bigram_sorted_keys)):
-        if i != bigram_sorted_keys[i]:
-            bigram_threshold = bigram_sorted_keys[i-1]
-            break
-    return Nx_unigram, unigram_threshold, Nx_bigram, bigram_threshold
-
-
-def score_words_gt(sentence, uniword, biword, Nx_uni, uni_threshold, Nx_bi, bi_threshold):
+    return Nx_unigram, turing_threshold(Nx_unigram), Nx_bigram, turing_threshold(Nx_bigram)
+
+
+def turing_threshold(Nx):
+    #returns the last x s.t. all of N(0), ..., N(x) are different from zero
+    #if there is no gap in the Nx's, the threshold is the highest count
+    sorted_keys = sorted(Nx.keys())
+    for i in range(0, len(sorted_keys)):
+        if i != sorted_keys[i]:
+            return sorted_keys[i-1]
+    return sorted_keys[-1]
+
+
+def dense_threshold(Nx):
+    #same as turing_threshold for the Nx's stored in an array indexed by count, where
+    #N(0) is implicit (see turing_smoothing_nx) and a missing count has a 0
+    gaps = np.flatnonzero(Nx[1:] == 0)
+    return int(gaps[0]) if len(gaps) else len(Nx) - 1
+
+
+def update_threshold(Nx, threshold, changed):
+    #incremental version of dense_threshold, after the Nx's of the counts in changed
+    #were updated: a count at or below the threshold that dropped to 0 is a new gap,
+    #otherwise the threshold can only move forward, over the gaps that were filled
+    gaps = [x for x in changed if 0 < x <= threshold and Nx[x] == 0]
+    if gaps:
+        return min(gaps) - 1
+    while threshold + 1 < len(Nx) and Nx[threshold + 1] != 0:
+        threshold += 1
+    return threshold
+
+
+def gt_proba(count, Nx, threshold, total):
+    #this function returns the Good-Turing smoothed probability of a token observed
+    #count times, exactly as computed in score_words_gt
+    if count < threshold:
+        return (count + 1) * Nx[count + 1] / (Nx[count] * total)
+    return count / total
+
+
+@profiled('turing_probability_table')
+def turing_probability_table(uniword, biword):
+    #this function builds everything that is needed to score a sentence with GT smoothing
+    #score_words_gt computes the smoothed probabilities on the fly and, for each bigram,
+    #it sums all the counts of the two dictionaries to obtain the totals
+    #here we do that work only once, at training time:
+    # - the totals of the unigram and bigram counts
+    # - the adjusted probability of every count below the GT threshold
+    # - the log-probability of every unigram and bigram seen in training
+    # - the log-probability of an unknown unigram and of an unknown bigram
+    #scoring a bigram is then a couple of dict lookups, irrespective of the vocabulary size
+    Nx_unigram, unigram_threshold, Nx_bigram, bigram_threshold = turing_smoothing_dict(uniword, biword)
+    unigram_total = sum(uniword.values())
+    bigram_total = sum(biword.values())
+    #probabilities are computed once per distinct count and shared by all tokens with that count
+    unigram_gt = {x: gt_proba(x, Nx_unigram, unigram_threshold, unigram_total)
+                  for x in range(unigram_threshold)}
+    bigram_gt = {x: gt_proba(x, Nx_bigram, bigram_threshold, bigram_total)
+                 for x in range(bigram_threshold)}
+    unigram_log = {}
+    bigram_log = {}
+    for key, count in uniword.items():
+        if count not in unigram_log:
+            unigram_log[count] = float(np.log(gt_proba(count, Nx_unigram, unigram_threshold, unigram_total)))
+    for key, count in biword.items():
+        if count not in bigram_log:
+            bigram_log[count] = float(np.log(gt_proba(count, Nx_bigram, bigram_threshold, bigram_total)))
+    return {'unigram_total': unigram_total,
+            'bigram_total': bigram_total,
+            'unigram_threshold': unigram_threshold,
+            'bigram_threshold': bigram_threshold,
+            'unigram_gt': unigram_gt,
+            'bigram_gt': bigram_gt,
+            'unigram_logprob': {key: unigram_log[count] for key, count in uniword.items()},
+            'bigram_logprob': {key: bigram_log[count] for key, count in biword.items()},
+            'unknown_unigram': float(np.log(gt_proba(0, Nx_unigram, unigram_threshold, unigram_total))),
+            'unknown_bigram': float(np.log(gt_proba(0, Nx_bigram, bigram_threshold, bigram_total)))}
+
+
+def gt_log_counts(counts, Nx, threshold, total):
+    #vectorized version of gt_proba that returns the log-probabilities of an array of counts
+    #probabilities are computed once per distinct count and shared by all tokens with that count
+    values, inverse = np.unique(counts, return_inverse=True)
+    return np.log([gt_proba(x, Nx, threshold, total) for x in values.tolist()])[inverse]
+
+
+def gt_log_table(Nx, threshold, total, size):
+    #returns the GT smoothed log-probabilities of all the counts from 0 to size - 1
+    #counts below the threshold go through gt_proba; the others are plain MLE and are
+    #computed at once (the divisions give the same floats as in gt_proba)
+    below = [gt_proba(x, Nx, threshold, total) for x in range(min(threshold, size))]
+    above = np.arange(len(below), size) / total
+    return np.log(np.concatenate((below, above)))
+
+
+def gt_logprob_arrays(unigram_counts, bigram_counts, bigram_first):
+    #this function precomputes the GT smoothed log-probabilities of score_words_gt
+    #it takes the counts of a language in a word store (see wordLangId.count_word_store)
+    #and the first word of each bigram (see wordLangId.store_predecessors) and returns:
+    # - the log of the conditional probability of each bigram of the store
+    # - the log of the conditional probability of a bigram never seen in training,
+    #   which only depends on the first word of the bigram
+    #words and bigrams with a count of 0 are unknowns for this language
+    Nx_unigram, unigram_threshold, Nx_bigram, bigram_threshold = turing_smoothing_counts(
+        unigram_counts[unigram_counts > 0].tolist(), bigram_counts[bigram_counts > 0].tolist())
+    unigram_total = int(unigram_counts.sum())
+    bigram_total = int(bigram_counts.sum())
+    unigram_log = gt_log_counts(unigram_counts, Nx_unigram, unigram_threshold, unigram_total)
+    bigram_log = gt_log_counts(bigram_counts, Nx_bigram, bigram_threshold, bigram_total)
+    unknown_bigram = np.log(gt_proba(0, Nx_bigram, bigram_threshold, bigram_total))
+    return bigram_log - unigram_log[bigram_first], unknown_bigram - unigram_log
+
+
+def score_words_gt_sketch(sentence_list, uniword, sketch):
+    #vectorized version of score_words_gt that reads the bigram counts from a count-min
+    #sketch (see wordLangId.bigram_word_sketch)
+    #the Nx's of the bigrams are the estimates kept by the sketch
+    #returns an array with the score of each sentence
+    Nx_unigram, unigram_threshold, Nx_bigram, bigram_threshold = turing_smoothing_nx(
+        Counter(uniword.values()), sketch['Nx'])
+    hashes, first_words, starts = sentence_bigram_hashes(sentence_list)
+    bigram_log = gt_log_counts(sketch_query(sketch, hashes), Nx_bigram, bigram_threshold, sketch['total'])
+    unigram_log = gt_log_counts(np.array([uniword.get(word, 0) for word in first_words]),
+                                Nx_unigram, unigram_threshold, sum(uniword.values()))
+    return sum_by_sentence(bigram_log - unigram_log, starts)
+
+
+def score_words_gt_sketch_model(sentence_list, sketch_model):
+    #counterpart of score_words_gt_model for the sketch backend of the word models
+    #(see wordLangId.train_word_sketches): returns a (sentences, languages) array of GT scores
+    return np.column_stack([score_words_gt_sketch(sentence_list, uniword, sketch)
+                            for uniword, sketch in zip(sketch_model['uniword'], sketch_model['sketches'])])
+
+
+def score_words_gt(sentence, uniword, biword, Nx_uni, uni_threshold, Nx_bi, bi_threshold, memo=None):
     #this is the function that performs the language model scoring for word bigrams
     #it takes a series of inputs:
     # - a sentence
@@ -67,6 +206,9 @@ def score_words_gt(sentence, uniword, biword, Nx_uni, uni_threshold, Nx_bi, bi_t
     #note that counts are smoothed using GT and turned into probabilities on the fly
     #also note that GT smoothing will be applied only to tokens that appeared
     #less than a given amount of times (as per the threshold parameters of this function)
+    #memo is an optional scoreCache.BigramMemo of the language of the two dictionaries:
+    #bigrams found in the memo are not smoothed again, which also saves the sums of
+    #all the counts below
 
     score = 0
     #the input is a single sentence
@@ -76,6 +218,10 @@ def score_words_gt(sentence, uniword, biword, Nx_uni, uni_threshold, Nx_bi, bi_t
     words = sentence.split()
     for i in range(0, len(words)+1):
         bigram_key = make_word_key(words, i)
+        if memo is not None and bigram_key in memo:
+            memo.hits += 1
+            score += memo[bigram_key]
+            continue
         unigram_key = bigram_key.split(' ')[0]
         
         #start by finding the count associated to the bigram and unigram
@@ -117,74 +263,84 @@ def score_words_gt(sentence, uniword, biword, Nx_uni, uni_threshold, Nx_bi, bi_t
         
         #now that we have probabilities, compute conditional probability    
         cond_proba = np.log(bigram_gt_proba/unigram_gt_proba)
+        if memo is not None:
+            memo.add(bigram_key, cond_proba)
         score += cond_proba
     return score
 
 
-def make_output_words_gt(test,
-                       uniword_dict_eng, biword_dict_eng,
-                         Nx_unigram_eng, unigram_threshold_eng, Nx_bigram_eng, bigram_threshold_eng,
-                       uniword_dict_ita, biword_dict_ita,
-                         Nx_unigram_ita, unigram_threshold_ita, Nx_bigram_ita, bigram_threshold_ita,
-                       uniword_dict_fra, biword_dict_fra,
-                         Nx_unigram_fra, unigram_threshold_fra, Nx_bigram_fra, bigram_threshold_fra):
-    #this function takes the test sentences and returns a list with the predicted
-    #language for each sentence in the test set
-    #for each sentence, model is scored using the ENG, ITA and FRA dictionaries
+@profiled('score_words_gt_table')
+def score_words_gt_table(sentence, gt_table):
+    #this function returns the same score as score_words_gt, using the output of
+    #turing_probability_table instead of the raw counts
+    #each bigram costs two dict lookups: log-probabilities are already smoothed
+    bigram_logprob = gt_table['bigram_logprob']
+    unigram_logprob = gt_table['unigram_logprob']
+    unknown_bigram = gt_table['unknown_bigram']
+    unknown_unigram = gt_table['unknown_unigram']
+    score = 0
+    words = sentence.split()
+    for i in range(0, len(words)+1):
+        bigram_key = make_word_key(words, i)
+        unigram_key = bigram_key.split(' ')[0]
+        #the conditional probability is the ratio of the two GT probabilities
+        score += (bigram_logprob.get(bigram_key, unknown_bigram) -
+                  unigram_logprob.get(unigram_key, unknown_unigram))
+    if profiling_enabled():
+        keys = [make_word_key(words, i) for i in range(0, len(words)+1)]
+        count_dict_lookups('score_words_gt_table', keys, [key.split(' ')[0] for key in keys],
+                           bigram_logprob, unigram_logprob)
+    return score
+
+
+def score_words_gt_model(sentence_list, model):
+    #scores a list of sentences against every language of a trained model with GT
+    #smoothing (see wordLangId.score_words_model)
+    return score_words_model(sentence_list, model, 'gt')
+
+
+def make_output_words_gt(test, model, cache=None):
+    #this function takes the test sentences and a trained model of any number of
+    #languages and returns a list with the predicted language for each sentence
     #the predicted language is the language that is associated to the highest proba
-    #since we are calling the score_words_gt function, we need to pass a fair
-    #bit of parameters to this function
-    #for each language, we need the count of unigrams and bigrams, the lists of Nx's
-    #and the threshold for GT smoothing
-    output = []
-    for i in range(len(test)):
-        test_line = test[i]
-        results = {'English': score_words_gt(test_line, uniword_dict_eng, biword_dict_eng,
-                                            Nx_unigram_eng, unigram_threshold_eng, Nx_bigram_eng, bigram_threshold_eng),
-                   'Italian': score_words_gt(test_line, uniword_dict_ita, biword_dict_ita,
-                                            Nx_unigram_ita, unigram_threshold_ita, Nx_bigram_ita, bigram_threshold_ita),
-                   'French' : score_words_gt(test_line, uniword_dict_fra, biword_dict_fra,
-                                            Nx_unigram_fra, unigram_threshold_fra, Nx_bigram_fra, bigram_threshold_fra)}
-        predicted_language = max(results.items(), key=operator.itemgetter(1))[0]
-        output.append('{} {}'.format(i+1, predicted_language))
-    return output
+    #with a scoreCache.ScoreCache of this model, sentences in the cache are not scored again
+    if cache is not None:
+        return make_output(score_cached(test, model, score_words_gt_model, cache), model['languages'])
+    return make_output(score_words_gt_model(test, model), model['languages'])
+
+
+def make_output_words_gt_sketch(test, sketch_model):
+    #same as make_output_words_gt with the sketch backend of the word models
+    return make_output(score_words_gt_sketch_model(test, sketch_model), sketch_model['languages'])
 
 
 def main():
-    #read train data
-    ita = read_files('LangId.train.Italian')
-    fra = read_files('LangId.train.French')
-    eng = read_files('LangId.train.English')
+    parser = argparse.ArgumentParser(description='Word bigram model with Good-Turing smoothing')
+    parser.add_argument('--backend', default='store', choices=['store', 'sketch'],
+                        help='store: exact bigram counts of the trained model (see modelStore); '
+                             'sketch: bigram counts in count-min sketches of fixed size')
+    parser.add_argument('--sketch-width', type=int, default=SKETCH_WIDTH)
+    parser.add_argument('--sketch-depth', type=int, default=SKETCH_DEPTH)
+    args = parser.parse_args()
+
+    #modelStore is imported here because it imports this module
+    from modelStore import load_or_train, discover_train_files
     #read test data
     test = read_files('LangId.test')
     #read ground truth, ie the solution
-    with open('LangId.sol', 'r') as file:
-        sol = file.readlines()
-        sol = [x.replace('\n', '') for x in sol]
-
-    #create word unigram counts
-    uniword_dict_ita = unigram_word_dict(ita)
-    uniword_dict_fra = unigram_word_dict(fra)
-    uniword_dict_eng = unigram_word_dict(eng)
-
-    #create word bigram counts
-    biword_dict_ita = bigram_word_dict(ita)
-    biword_dict_fra = bigram_word_dict(fra)
-    biword_dict_eng = bigram_word_dict(eng)
-
-    #compute Nx's lists and thresholds for unigrams and bigrams
-    Nx_unigram_ita, unigram_threshold_ita, Nx_bigram_ita, bigram_threshold_ita = turing_smoothing_dict(uniword_dict_ita, biword_dict_ita)
-    Nx_unigram_fra, unigram_threshold_fra, Nx_bigram_fra, bigram_threshold_fra = turing_smoothing_dict(uniword_dict_fra, biword_dict_fra)
-    Nx_unigram_eng, unigram_threshold_eng, Nx_bigram_eng, bigram_threshold_eng = turing_smoothing_dict(uniword_dict_eng, biword_dict_eng)
+    sol = read_solution('LangId.sol')
 
     #create list with predicted languages of all sentences in test data
-    output_word_gt = make_output_words_gt(test,
-                       uniword_dict_eng, biword_dict_eng,
-                         Nx_unigram_eng, unigram_threshold_eng, Nx_bigram_eng, bigram_threshold_eng,
-                       uniword_dict_ita, biword_dict_ita,
-                         Nx_unigram_ita, unigram_threshold_ita, Nx_bigram_ita, bigram_threshold_ita,
-                       uniword_dict_fra, biword_dict_fra,
-                         Nx_unigram_fra, unigram_threshold_fra, Nx_bigram_fra, bigram_threshold_fra)
+    if args.backend == 'sketch':
+        #the sketches are trained from the corpora at every run
+        sketch_model = train_word_sketches(discover_train_files(), args.sketch_width, args.sketch_depth)
+        output_word_gt = make_output_words_gt_sketch(test, sketch_model)
+    else:
+        #load the trained model of all languages (see modelStore)
+        #the model is trained from the corpora only if it was never saved or if the
+        #corpora changed since
+        model = load_or_train()
+        output_word_gt = make_output_words_gt(test, model)
 
     #write output to file
     write_out('wordLangId2.out', output_word_gt)
@@ -193,6 +349,10 @@ def main():
     perf = compute_performance(output_word_gt, sol)
     print('Accuracy of word bigram model with Good-Turing smoothing: {}%'.format(perf))
 
+    #write the profile to the standard error if profiling is on (see profiler)
+    if profiling_enabled():
+        dump_profile()
+
 
 if __name__ == "__main__":
     main()